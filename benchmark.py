@@ -0,0 +1,144 @@
+"""Parser throughput benchmarks on a synthetic BMP stream.
+
+Runs the framing, parsing and serialization stages in-process on a stream
+from bmp_synth, serialization with both encoders (orjson when installed and
+the fragment fallback), and parsing from a pcap of the same stream (TCP
+reassembly included), Elasticsearch is never contacted. Every stage is run
+--repeat times and the best run is reported, with the peak memory traced
+during one extra run. Results can be saved and compared with a previous run:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+import tracemalloc
+import bmp_synth
+import evpn_parser
+import pcap_reader
+import serialization
+
+
+def stage_framing(blob, _):
+    pos = 0
+    frames = 0
+    while True:
+        frame, pos = evpn_parser.next_frame(blob, pos)
+        if frame is None:
+            return frames
+        frames += 1
+
+
+def stage_parsing(blob, _):
+    messages = []
+    evpn_parser.run(memoryview(blob), messages.append)
+    return messages
+
+
+def stage_orjson(_, messages):
+    return [serialization.orjson.dumps(message.to_dict())
+            for message in messages]
+
+
+def stage_fragments(_, messages):
+    return [serialization._encode_fragments(message) for message in messages]
+
+
+def stage_pcap(capture, _):
+    messages = []
+    pcap_reader.CaptureReader().read(io.BytesIO(capture), messages.append)
+    return messages
+
+
+stages = [
+    ("framing", stage_framing),
+    ("parsing", stage_parsing),
+    ("orjson", stage_orjson),
+    ("fragments", stage_fragments),
+    ("pcap", stage_pcap),
+]
+
+
+def measure(function, blob, messages, repeat):
+    best = None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            began = time.perf_counter()
+            result = function(blob, messages)
+            elapsed = time.perf_counter() - began
+            best = elapsed if best is None else min(best, elapsed)
+        tracemalloc.start()
+        function(blob, messages)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def run_benchmarks(args):
+    blob, message_count, nlri_count = bmp_synth.generate(
+        args.peers, args.updates, args.mac_routes, args.prefix_routes,
+        args.withdraw_ratio, args.seed)
+    capture = bmp_synth.pcap(blob, seed=args.seed)
+    results = {}
+    messages = None
+    for name, function in stages:
+        if name == "orjson" and serialization.orjson is None:
+            continue
+        source = capture if name == "pcap" else blob
+        elapsed, peak, result = measure(function, source, messages, args.repeat)
+        if name == "parsing":
+            messages = result
+        results[name] = {
+            "seconds": elapsed,
+            "messages_per_s": message_count / elapsed,
+            "nlris_per_s": nlri_count / elapsed,
+            "bytes_per_s": len(blob) / elapsed,
+            "peak_memory": peak,
+        }
+    return {"stream": {"messages": message_count, "nlris": nlri_count,
+                       "bytes": len(blob)},
+            "encoder": serialization.encoder_name, "stages": results}
+
+
+def print_results(results, baseline=None):
+    stream = results["stream"]
+    print("stream: {messages} messages, {nlris} NLRIs, {bytes} bytes".format(
+        **stream))
+    print("encoder: {}".format(results["encoder"]))
+    print("{:<14}{:>12}{:>14}{:>12}{:>12}{:>10}".format(
+        "stage", "msg/s", "NLRI/s", "MB/s", "peak MB", "vs base"))
+    for name, stage in results["stages"].items():
+        change = ""
+        if baseline is not None and name in baseline["stages"]:
+            change = "{:.2f}x".format(
+                stage["messages_per_s"] / baseline["stages"][name]["messages_per_s"])
+        print("{:<14}{:>12.0f}{:>14.0f}{:>12.1f}{:>12.1f}{:>10}".format(
+            name, stage["messages_per_s"], stage["nlris_per_s"],
+            stage["bytes_per_s"] / 1e6, stage["peak_memory"] / 1e6, change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peers", type=int, default=8)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--mac-routes", type=int, default=4)
+    parser.add_argument("--prefix-routes", type=int, default=1)
+    parser.add_argument("--withdraw-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+    results = run_benchmarks(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,269 @@
+import datetime
+import functools
+import json
+
+
+@functools.lru_cache(maxsize=1024)
+def format_esi(esi):
+    """The 80 bit ESI as colon separated hex, no JSON number can hold it."""
+    return esi.to_bytes(10, byteorder="big").hex(":")
+
+
+class PerPeerHeader:
+    __slots__ = ("peer_type", "flags", "peer_distinguisher", "address",
+                 "as_number", "bgp_id", "timestamp_real")
+
+    def __init__(self, peer_type, flags, peer_distinguisher, address,
+                 as_number, bgp_id, timestamp_real):
+        self.peer_type = peer_type
+        self.flags = flags
+        self.peer_distinguisher = peer_distinguisher
+        self.address = address
+        self.as_number = as_number
+        self.bgp_id = bgp_id
+        self.timestamp_real = timestamp_real
+
+    def to_dict(self):
+        return {
+            "peer_type": self.peer_type,
+            "flags": self.flags,
+            "peer_distinguisher": str(self.peer_distinguisher),
+            "address": self.address,
+            "as_number": self.as_number,
+            "bgp_id": self.bgp_id,
+        }
+
+
+class OpenMessage:
+    __slots__ = ("bgp_version", "my_as", "hold_time", "bgp_identifier")
+
+    def __init__(self, bgp_version, my_as, hold_time, bgp_identifier):
+        self.bgp_version = bgp_version
+        self.my_as = my_as
+        self.hold_time = hold_time
+        self.bgp_identifier = bgp_identifier
+
+    def to_dict(self):
+        return {
+            "bgp_version": self.bgp_version,
+            "my_as": self.my_as,
+            "bgp_identifier": self.bgp_identifier,
+        }
+
+
+class MacRoute:
+    __slots__ = ("route_distinguisher", "esi", "ethernet_tag_id",
+                 "mac_address", "ip_address", "mpls_label", "reachable")
+
+    evpn_route_type = "MAC Advertisement"
+
+    def __init__(self, route_distinguisher, esi, ethernet_tag_id, mac_address,
+                 ip_address, mpls_label, reachable):
+        self.route_distinguisher = route_distinguisher
+        self.esi = esi
+        self.ethernet_tag_id = ethernet_tag_id
+        self.mac_address = mac_address
+        self.ip_address = ip_address
+        self.mpls_label = mpls_label
+        self.reachable = reachable
+
+    def to_dict(self):
+        return {
+            "evpn_route_type": self.evpn_route_type,
+            "type": "New Route" if self.reachable else "Withdrawn",
+            "route_distinguisher": str(self.route_distinguisher),
+            "esi": format_esi(self.esi),
+            "ethernet_tag_id": self.ethernet_tag_id,
+            "mac_address": self.mac_address,
+            "ip_address": self.ip_address,
+            "mpls_label": self.mpls_label
+        }
+
+
+class IpPrefixRoute:
+    __slots__ = ("route_distinguisher", "esi", "ethernet_tag_id",
+                 "ip_prefix_length", "ip_address", "ip_gateway", "mpls_label",
+                 "reachable")
+
+    evpn_route_type = "IP Prefix Route"
+
+    def __init__(self, route_distinguisher, esi, ethernet_tag_id,
+                 ip_prefix_length, ip_address, ip_gateway, mpls_label,
+                 reachable):
+        self.route_distinguisher = route_distinguisher
+        self.esi = esi
+        self.ethernet_tag_id = ethernet_tag_id
+        self.ip_prefix_length = ip_prefix_length
+        self.ip_address = ip_address
+        self.ip_gateway = ip_gateway
+        self.mpls_label = mpls_label
+        self.reachable = reachable
+
+    def to_dict(self):
+        return {
+            "evpn_route_type": self.evpn_route_type,
+            "type": "New Route" if self.reachable else "Withdrawn",
+            "route_distinguisher": str(self.route_distinguisher),
+            "esi": format_esi(self.esi),
+            "ethernet_tag_id": self.ethernet_tag_id,
+            "ip_prefix_length": self.ip_prefix_length,
+            "ip_address": self.ip_address,
+            "ip_gateway": self.ip_gateway,
+            "mpls_label": self.mpls_label
+        }
+
+
+class ExtendedCommunity:
+    __slots__ = ("ec_type", "ec_subtype", "global_adm", "local_adm")
+
+    def __init__(self, ec_type, ec_subtype, global_adm, local_adm):
+        self.ec_type = ec_type
+        self.ec_subtype = ec_subtype
+        self.global_adm = global_adm
+        self.local_adm = local_adm
+
+    def to_dict(self):
+        return {
+            "type": self.ec_type,
+            "subtype": self.ec_subtype,
+            "2_bytes_value": self.global_adm,
+            "4_bytes_value": self.local_adm
+        }
+
+
+class BMPMessage:
+    """One decoded BMP message.
+
+    The parser fills it through the set_* methods, values are kept as plain
+    attributes and typed route records and are only turned into the indexed
+    document shape by to_dict(), at the output sink.
+    """
+
+    __slots__ = ("timestamp_received", "bmp_version", "message_length",
+                 "bmp_message_type", "per_peer_header", "local_address",
+                 "local_port", "remote_port", "peer_down_reason",
+                 "bgp_message_type",
+                 "bgp_length", "notification", "opens", "update",
+                 "next_hop", "extended_communities", "as_path", "coalesced")
+
+    def __init__(self):
+        self.timestamp_received = None
+        self.per_peer_header = None
+        self.local_address = None
+        self.peer_down_reason = None
+        self.bgp_message_type = None
+        self.notification = None
+        self.opens = None
+        self.update = None
+        self.next_hop = None
+        self.extended_communities = None
+        self.as_path = None
+        self.coalesced = None
+
+    def set_bmp_common(self, version, message_length, message_type):
+        self.bmp_version = version
+        self.message_length = message_length
+        self.bmp_message_type = message_type
+
+    def set_received_time(self):
+        self.timestamp_received = datetime.datetime.now()
+
+    def set_bmp_per_peer(self, peer_type, flags, peer_distinguisher, address, asn, bgp_id, timestamp_sec, timestamp_msec):
+        self.per_peer_header = PerPeerHeader(
+            peer_type, flags, peer_distinguisher, address, asn, bgp_id,
+            timestamp_sec)
+
+    def set_bmp_peer_up(self, local_address, local_port, remote_port):
+        self.local_address = local_address
+        self.local_port = local_port
+        self.remote_port = remote_port
+
+    def set_bmp_peer_down(self, reason):
+        self.peer_down_reason = reason
+
+    def set_bgp_basics(self, length, message_type):
+        self.bgp_length = length
+        self.bgp_message_type = message_type
+
+    def set_bgp_notification(self, error_code, error_subcode):
+        self.notification = (error_code, error_subcode)
+
+    def set_bgp_open(self, bgp_version, my_as, hold_time, bgp_identifier):
+        if self.opens is None:
+            self.opens = []
+        self.opens.append(
+            OpenMessage(bgp_version, my_as, hold_time, bgp_identifier))
+
+    def set_bgp_update(self):
+        self.update = []
+
+    def set_bgp_next_hop(self, next_hop):
+        # Kept for the RIB, not part of the indexed document
+        self.next_hop = next_hop
+
+    def set_bgp_nlri_mac(self, route_distinguisher, esi, ethernet_tag_id, mac_address, ip_address, mpls_label, nlri):
+        self.update.append(MacRoute(
+            route_distinguisher, esi, ethernet_tag_id, mac_address,
+            ip_address, mpls_label, nlri))
+
+    def set_bgp_nlri_ip(self, route_distinguisher, esi, ethernet_tag_id, ip_prefix_length, ip_address, ip_gateway, mpls_label, nlri):
+        self.update.append(IpPrefixRoute(
+            route_distinguisher, esi, ethernet_tag_id, ip_prefix_length,
+            ip_address, ip_gateway, mpls_label, nlri))
+
+    def set_bgp_extended_community(self):
+        self.extended_communities = []
+
+    def set_bgp_extended_community_entry(self, ec_type, ec_subtype, global_adm, local_adm):
+        self.extended_communities.append(
+            ExtendedCommunity(ec_type, ec_subtype, global_adm, local_adm))
+
+    def set_as_path(self, segment):
+        self.as_path = segment
+
+    def to_dict(self):
+        document = {"timestamp_received": self.timestamp_received.isoformat()}
+        bmp_header = {
+            "bmp_version": self.bmp_version,
+            "message_length": self.message_length,
+            "message_type": self.bmp_message_type
+        }
+        document["bmp_header"] = bmp_header
+        if self.per_peer_header is not None:
+            bmp_header["per_peer_header"] = self.per_peer_header.to_dict()
+            document["timestamp_real"] = self.per_peer_header.timestamp_real
+        if self.local_address is not None:
+            bmp_header["local_address"] = self.local_address
+            bmp_header["local_port"] = self.local_port
+            bmp_header["remote_port"] = self.remote_port
+        if self.peer_down_reason is not None:
+            bmp_header["peer_down_reason"] = self.peer_down_reason
+        if self.bgp_message_type is None:
+            return document
+        bgp_message = {
+            "message_type": self.bgp_message_type,
+            "length": self.bgp_length
+        }
+        document["bgp_message"] = bgp_message
+        if self.notification is not None:
+            bgp_message["notification"] = {
+                "error_code": self.notification[0],
+                "error_subcode": self.notification[1]
+            }
+        if self.opens is not None:
+            bgp_message["open"] = {
+                peer: open_message.to_dict() for peer, open_message in
+                zip(("peer_one", "peer_two"), self.opens)}
+        if self.update is not None:
+            bgp_message["update"] = [route.to_dict() for route in self.update]
+        if self.extended_communities is not None:
+            bgp_message["extended_communities"] = [
+                ec.to_dict() for ec in self.extended_communities]
+        if self.as_path is not None:
+            bgp_message["as_path"] = self.as_path
+        if self.coalesced is not None:
+            document["coalesced"] = self.coalesced.to_dict()
+        return document
+
+    def get_json(self):
+        return json.dumps(self.to_dict(), indent=2)
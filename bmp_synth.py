@@ -0,0 +1,216 @@
+"""Synthetic BMP stream generator.
+
+Builds byte-exact BMP v3 feeds for benchmarks and lab replays: an
+Initiation message, a Peer Up with both OPENs per peer, Route Monitoring
+UPDATEs carrying EVPN type-2 and type-5 NLRIs with extended communities, and
+a Peer Down with a Cease NOTIFICATION per peer.
+
+    python bmp_synth.py capture.bin --peers 8 --updates 100000
+"""
+import argparse
+import random
+import socket
+import struct
+
+marker = b'\xff' * 16
+
+
+def bgp_pdu(message_type, body):
+    return marker + struct.pack("!HB", 19 + len(body), message_type) + body
+
+
+def bmp_message(message_type, body):
+    return struct.pack("!BIB", 3, 6 + len(body), message_type) + body
+
+
+def per_peer_header(peer, timestamp):
+    return (struct.pack("!BBQ", 0, 0, 0) + bytes(12) +
+            socket.inet_aton(peer["address"]) +
+            struct.pack("!I", peer["asn"]) + socket.inet_aton(peer["bgp_id"]) +
+            struct.pack("!II", timestamp, 0))
+
+
+def route_distinguisher(ip, assigned):
+    return struct.pack("!H", 1) + socket.inet_aton(ip) + struct.pack("!H", assigned)
+
+
+def mac_route(rd, mac, ip, label):
+    body = (rd + bytes(10) + struct.pack("!I", 0) + b'\x30' + mac + b'\x20' +
+            socket.inet_aton(ip) + label.to_bytes(3, "big"))
+    return bytes([2, len(body)]) + body
+
+
+def prefix_route(rd, prefix, prefix_length, label):
+    body = (rd + bytes(10) + struct.pack("!I", 0) + bytes([prefix_length]) +
+            socket.inet_aton(prefix) + bytes(4) + label.to_bytes(3, "big"))
+    return bytes([5, len(body)]) + body
+
+
+def path_attribute(flags, attribute_type, value):
+    if len(value) > 255:
+        flags |= 0x10
+    if flags & 0x10:  # Extended Length
+        return struct.pack("!BBH", flags, attribute_type, len(value)) + value
+    return struct.pack("!BBB", flags, attribute_type, len(value)) + value
+
+
+def update(peer, nlris, withdraw, mobility_sequence):
+    attributes = path_attribute(0x40, 1, b'\x00')
+    attributes += path_attribute(0x50, 2, struct.pack(
+        "!BBII", 2, 2, peer["asn"], 65000))
+    communities = struct.pack("!BBHI", 0, 2, peer["asn"], 100)
+    communities += struct.pack("!BBHI", 6, 0, 0, mobility_sequence)
+    attributes += path_attribute(0xc0, 16, communities)
+    if withdraw:
+        attributes += path_attribute(0x90, 15, struct.pack("!HB", 25, 70) + nlris)
+    else:
+        attributes += path_attribute(0x90, 14, struct.pack("!HBB", 25, 70, 4) +
+                                     socket.inet_aton(peer["bgp_id"]) + b'\x00' +
+                                     nlris)
+    return bgp_pdu(2, struct.pack("!HH", 0, len(attributes)) + attributes)
+
+
+def open_pdu(asn, bgp_id):
+    return bgp_pdu(1, struct.pack("!BHH", 4, asn, 180) +
+                   socket.inet_aton(bgp_id) + b'\x00')
+
+
+def initiation():
+    return bmp_message(4, struct.pack("!HH", 0, 9) + b'bmp_synth')
+
+
+def termination(reason=0):
+    return bmp_message(5, struct.pack("!HHH", 1, 2, reason))
+
+
+def peer_up(peer, timestamp):
+    return bmp_message(3, per_peer_header(peer, timestamp) + bytes(12) +
+                       socket.inet_aton("10.10.10.254") +
+                       struct.pack("!HH", 179, 40000) +
+                       open_pdu(65000, "10.10.10.254") +
+                       open_pdu(peer["asn"], peer["bgp_id"]))
+
+
+def peer_down(peer, timestamp, reason=1, error_code=6):
+    """Peer Down with a NOTIFICATION of error_code (Cease by default) for
+    reasons 1 and 3, an FSM event code for reason 2 and nothing more for the
+    others."""
+    if reason in (1, 3):
+        data = bgp_pdu(3, bytes([error_code, 2]))
+    elif reason == 2:
+        data = struct.pack("!H", 0)
+    else:
+        data = b''
+    return bmp_message(2, per_peer_header(peer, timestamp) + bytes([reason]) +
+                       data)
+
+
+def make_peers(count):
+    return [{"address": "10.10.10.{}".format(i + 1),
+             "bgp_id": "10.10.10.{}".format(i + 1),
+             "asn": 65001 + i} for i in range(count)]
+
+
+def generate(peers=4, updates=1000, mac_routes=4, prefix_routes=1,
+             withdraw_ratio=0.2, seed=1):
+    """Return a BMP stream, and the number of messages and NLRIs in it.
+
+    updates Route Monitoring messages are spread over the peers, each one
+    carrying mac_routes type-2 and prefix_routes type-5 NLRIs. A share of
+    withdraw_ratio of them are MP_UNREACH withdrawals. The same seed always
+    gives the same stream.
+    """
+    rng = random.Random(seed)
+    peer_list = make_peers(peers)
+    timestamp = 1600000000
+    chunks = [initiation()]
+    messages = 1
+    nlri_count = 0
+    for peer in peer_list:
+        chunks.append(peer_up(peer, timestamp))
+        messages += 1
+    for i in range(updates):
+        peer = peer_list[i % peers]
+        rd = route_distinguisher(peer["address"], rng.randrange(1, 16))
+        nlris = []
+        for _ in range(mac_routes):
+            host = rng.randrange(1 << 16)
+            mac = bytes([0x00, 0x11, 0x22, 0x33, host >> 8, host & 0xff])
+            nlris.append(mac_route(rd, mac, "10.1.{}.{}".format(
+                host >> 8, host & 0xff), 257))
+        for _ in range(prefix_routes):
+            nlris.append(prefix_route(rd, "10.{}.{}.0".format(
+                rng.randrange(256), rng.randrange(256)), 24, 257))
+        chunks.append(bmp_message(0, per_peer_header(peer, timestamp + i // 1000) +
+                                  update(peer, b''.join(nlris),
+                                         rng.random() < withdraw_ratio,
+                                         rng.randrange(16))))
+        messages += 1
+        nlri_count += len(nlris)
+    for peer in peer_list:
+        chunks.append(peer_down(peer, timestamp + updates // 1000))
+        messages += 1
+    return b''.join(chunks), messages, nlri_count
+
+
+def tcp_packet(source, destination, source_port, destination_port, seq,
+               flags, payload):
+    tcp = struct.pack("!HHIIBBHHH", source_port, destination_port, seq, 0,
+                      5 << 4, flags, 65535, 0, 0)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp) + len(payload), 0,
+                     0x4000, 64, 6, 0, socket.inet_aton(source),
+                     socket.inet_aton(destination))
+    ethernet = bytes(6) + bytes.fromhex("020000000001") + b'\x08\x00'
+    return ethernet + ip + tcp + payload
+
+
+def pcap(blob, port=11019, mss=1448, reorder=0.01, retransmit=0.01, seed=1):
+    """Wrap a BMP stream in a pcap of one router to collector TCP session,
+    with a share of segments swapped with the next one or sent twice. The
+    sequence numbers wrap around during the session."""
+    rng = random.Random(seed)
+    isn = (1 << 32) - 100000
+    router, collector = "192.0.2.1", "192.0.2.254"
+    segments = [tcp_packet(router, collector, 40000, port, isn, 0x02, b'')]
+    data = []
+    for pos in range(0, len(blob), mss):
+        data.append(tcp_packet(router, collector, 40000, port,
+                               (isn + 1 + pos) % (1 << 32), 0x18,
+                               blob[pos:pos+mss]))
+    for i in range(len(data) - 1):
+        if rng.random() < reorder:
+            data[i], data[i+1] = data[i+1], data[i]
+    for packet in data:
+        segments.append(packet)
+        if rng.random() < retransmit:
+            segments.append(packet)
+    segments.append(tcp_packet(router, collector, 40000, port,
+                               (isn + 1 + len(blob)) % (1 << 32), 0x11, b''))
+    chunks = [struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+    for i, packet in enumerate(segments):
+        chunks.append(struct.pack("<IIII", 1600000000 + i // 1000,
+                                  i % 1000 * 1000, len(packet), len(packet)))
+        chunks.append(packet)
+    return b''.join(chunks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic BMP stream")
+    parser.add_argument("output")
+    parser.add_argument("--peers", type=int, default=4)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--mac-routes", type=int, default=4,
+                        help="type-2 NLRIs per UPDATE")
+    parser.add_argument("--prefix-routes", type=int, default=1,
+                        help="type-5 NLRIs per UPDATE")
+    parser.add_argument("--withdraw-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--pcap", action="store_true",
+                        help="write a pcap of the TCP session instead")
+    args = parser.parse_args()
+    blob, messages, nlris = generate(args.peers, args.updates, args.mac_routes,
+                                     args.prefix_routes, args.withdraw_ratio,
+                                     args.seed)
+    with open(args.output, "wb") as f:
+        f.write(pcap(blob, seed=args.seed) if args.pcap else blob)
+    print("{} messages, {} NLRIs, {} bytes".format(messages, nlris, len(blob)))
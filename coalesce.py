@@ -0,0 +1,231 @@
+"""Flap coalescing in front of the Elasticsearch sink.
+
+A flapping route is advertised and withdrawn over and over, and each flip
+is indexed as its own document. The Coalescer indexes the first update of a
+route (peer, RD and route key) as usual, then folds the updates of the same
+route that follow within the window into a single summary document, sent
+when the window closes. An UPDATE carrying several routes is only folded
+when all of them are in a window, it is never split.
+
+The summary has the shape of a regular UPDATE document: the route in its
+final state, at the timestamp of the last folded update, with the headers
+and attributes of that update. A "coalesced" field adds the first and last
+timestamps folded, the number of flips and the final state. The first
+update and the summary so keep the start and end of every convergence
+event, the flips in between are only counted.
+"""
+import collections
+import threading
+import time
+import bmp_records
+import evpn_parser
+import metrics
+import rib
+
+route_states = {True: "New Route", False: "Withdrawn"}
+
+
+def copy_message(message, routes):
+    """A copy of message carrying routes instead of its own."""
+    copy = bmp_records.BMPMessage()
+    for name in bmp_records.BMPMessage.__slots__:
+        if hasattr(message, name):
+            setattr(copy, name, getattr(message, name))
+    copy.update = routes
+    return copy
+
+
+class CoalesceSummary:
+    __slots__ = ("first_timestamp", "last_timestamp", "flips",
+                 "advertisements", "withdrawals", "final_state")
+
+    def __init__(self, first_timestamp, last_timestamp, flips, advertisements,
+                 withdrawals, final_state):
+        self.first_timestamp = first_timestamp
+        self.last_timestamp = last_timestamp
+        self.flips = flips
+        self.advertisements = advertisements
+        self.withdrawals = withdrawals
+        self.final_state = final_state
+
+    def to_dict(self):
+        return {
+            "first_timestamp": self.first_timestamp.isoformat(),
+            "last_timestamp": self.last_timestamp.isoformat(),
+            "flips": self.flips,
+            "advertisements": self.advertisements,
+            "withdrawals": self.withdrawals,
+            "final_state": self.final_state
+        }
+
+
+class Window:
+    """Updates of one route folded since its window opened."""
+    __slots__ = ("opened", "number", "reachable", "first", "last", "flips",
+                 "advertisements", "withdrawals", "route", "message")
+
+    def __init__(self, opened, number, reachable):
+        self.opened = opened
+        self.number = number
+        self.reachable = reachable
+        self.first = None
+        self.last = None
+        self.flips = 0
+        self.advertisements = 0
+        self.withdrawals = 0
+        self.route = None
+        self.message = None
+
+    def fold(self, route, message):
+        if route.reachable != self.reachable:
+            self.flips += 1
+            self.reachable = route.reachable
+        if route.reachable:
+            self.advertisements += 1
+        else:
+            self.withdrawals += 1
+        if self.first is None:
+            self.first = message.timestamp_received
+        self.last = message.timestamp_received
+        self.route = route
+        self.message = message
+
+    def state(self):
+        """What the summary of the window says, windows in the same state
+        share a summary."""
+        return (id(self.message), self.first, self.flips, self.advertisements,
+                self.withdrawals, self.reachable)
+
+    def summary(self, routes):
+        """The summary message carrying routes, the folded routes of the
+        windows in this state."""
+        message = copy_message(self.message, routes)
+        if not self.reachable:
+            # The attributes belong to advertisements
+            message.next_hop = message.extended_communities = None
+            message.as_path = None
+        message.coalesced = CoalesceSummary(
+            self.first, self.last, self.flips, self.advertisements,
+            self.withdrawals, route_states[self.reachable])
+        return message
+
+
+class Coalescer:
+    """Sink folding the route flaps of each window before the wrapped sink.
+
+    Windows are fixed and measured on message time (timestamp_received), so
+    a backlog read back from the spool folds what arrived close together,
+    not what is processed close together. A window closes once an update
+    `window` seconds younger than the one that opened it is submitted, or
+    by a timer thread when the feed goes quiet, message time then moving
+    on with the clock from the newest update. An UPDATE is folded only when every route it carries
+    has a window open, one opening a window is sent whole. close() sends
+    the summaries of the windows still open and closes the wrapped sink.
+    A checkpoint is held until the windows opened before it are closed and
+    their summaries sent, the updates they fold are so indexed again after
+    a crash.
+    """
+
+    def __init__(self, sink, window=1.0):
+        self.sink = sink
+        self.window = window
+        self.lock = threading.Lock()
+        # Ordered by opening time, so expired windows are at the front
+        self.windows = collections.OrderedDict()
+        # Newest timestamp_received, in epoch seconds, and when it was seen
+        self.latest = None
+        self.latest_at = None
+        self.opened = 0
+        # (windows opened before it, callback)
+        self.checkpoints = collections.deque()
+        self.folded = 0
+        self.summaries = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._timer, daemon=True)
+        self.thread.start()
+
+    def submit(self, message):
+        if message.update and message.per_peer_header is not None and \
+                evpn_parser.bmp_message_types[message.bmp_message_type] == \
+                "Route Monitoring":
+            header = message.per_peer_header
+            peer = (str(header.peer_distinguisher), header.address)
+            keys = [(peer, rib.route_key(route)) for route in message.update]
+            now = message.timestamp_received.timestamp()
+            with self.lock:
+                if self.latest is None or now > self.latest:
+                    self.latest = now
+                    self.latest_at = time.monotonic()
+                self._expire(self.latest)
+                if all(key in self.windows for key in keys):
+                    for key, route in zip(keys, message.update):
+                        self.windows[key].fold(route, message)
+                    self.folded += len(keys)
+                    metrics.coalesced_updates.inc(len(keys), ("folded",))
+                    return
+                for key, route in zip(keys, message.update):
+                    window = self.windows.get(key)
+                    if window is None:
+                        self.opened += 1
+                        self.windows[key] = Window(now, self.opened,
+                                                   route.reachable)
+                    else:
+                        # Indexed as is, not a flip of the summary
+                        window.reachable = route.reachable
+        self.sink.submit(message)
+
+    def _expire(self, now):
+        """Close the windows opened a window before now, sending their
+        summaries and then the checkpoints they held. Called locked."""
+        held = collections.OrderedDict()
+        deadline = now - self.window
+        while self.windows:
+            key, window = next(iter(self.windows.items()))
+            if window.opened > deadline:
+                break
+            del self.windows[key]
+            if window.message is not None:
+                held.setdefault(window.state(), []).append(window)
+        # The routes of an UPDATE folded whole go on sharing a document
+        for windows in held.values():
+            self.sink.submit(windows[0].summary(
+                [window.route for window in windows]))
+        self.summaries += len(held)
+        metrics.coalesced_updates.inc(len(held), ("summary",))
+        if self.windows:
+            oldest = next(iter(self.windows.values())).number
+        else:
+            oldest = self.opened + 1
+        while self.checkpoints and self.checkpoints[0][0] < oldest:
+            self.sink.checkpoint(self.checkpoints.popleft()[1])
+
+    def _clock(self):
+        """Message time now, the newest update moved on by the time since it
+        was submitted. Called locked."""
+        if self.latest is None:
+            return float("-inf")
+        return self.latest + time.monotonic() - self.latest_at
+
+    def _timer(self):
+        while not self.stopping.wait(min(self.window, 1.0)):
+            with self.lock:
+                self._expire(self._clock())
+
+    def checkpoint(self, callback):
+        with self.lock:
+            self.checkpoints.append((self.opened, callback))
+            self._expire(self._clock())
+
+    def stop_retrying(self):
+        self.sink.stop_retrying()
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        with self.lock:
+            self._expire(float("inf"))
+        self.sink.close()
+
+    def report(self):
+        return "coalescer {} updates folded into {} summaries, {} windows " \
+            "open".format(self.folded, self.summaries, len(self.windows))
@@ -0,0 +1,178 @@
+"""Elasticsearch index template, mappings and rollover of the ingest indices.
+
+Documents are written to an alias. setup() installs an index lifecycle
+policy rolling the index behind the alias over daily or once a primary
+shard reaches a size, and an index template giving every index of the alias
+explicit mappings: keyword, date, ip and integer fields for what is
+searched and aggregated on, the rest kept in _source only. The routes of an
+UPDATE are nested documents, searched and aggregated through nested queries
+and aggregations. Unknown fields are not mapped (dynamic false), so a new
+document shape cannot grow the mapping.
+
+Searches go to the alias, which spans every rolled index, and skip the
+indices whose timestamps are out of a query's range.
+"""
+import logging
+import urllib.parse
+import requests
+
+log = logging.getLogger("es_index")
+
+# Stored and returned in _source, never searched on
+unindexed = {"index": False, "doc_values": False}
+unindexed_keyword = {"type": "keyword", "index": False, "doc_values": False}
+
+route_properties = {
+    "evpn_route_type": {"type": "keyword"},
+    "type": {"type": "keyword"},
+    "route_distinguisher": {"type": "keyword"},
+    # 80 bit values, colon separated hex
+    "esi": {"type": "keyword"},
+    "ethernet_tag_id": dict(unindexed, type="long"),
+    "mac_address": {"type": "keyword"},
+    "ip_address": {"type": "ip"},
+    "ip_prefix_length": {"type": "integer"},
+    "ip_gateway": dict(unindexed, type="ip"),
+    "mpls_label": unindexed_keyword,
+}
+
+open_properties = {
+    "bgp_version": dict(unindexed, type="integer"),
+    "my_as": {"type": "long"},
+    "bgp_identifier": {"type": "ip"},
+}
+
+mappings = {
+    "dynamic": False,
+    "properties": {
+        "timestamp_received": {"type": "date"},
+        "timestamp_real": {"type": "date"},
+        "bmp_header": {
+            "properties": {
+                "bmp_version": dict(unindexed, type="integer"),
+                "message_length": dict(unindexed, type="integer"),
+                "message_type": {"type": "integer"},
+                "local_address": {"type": "ip"},
+                "local_port": dict(unindexed, type="integer"),
+                "remote_port": dict(unindexed, type="integer"),
+                "peer_down_reason": {"type": "integer"},
+                "per_peer_header": {
+                    "properties": {
+                        "peer_type": {"type": "integer"},
+                        "flags": dict(unindexed, type="integer"),
+                        "peer_distinguisher": {"type": "keyword"},
+                        "address": {"type": "ip"},
+                        "as_number": {"type": "long"},
+                        "bgp_id": {"type": "ip"},
+                    }
+                },
+            }
+        },
+        "bgp_message": {
+            "properties": {
+                "message_type": {"type": "keyword"},
+                "length": dict(unindexed, type="integer"),
+                "notification": {
+                    "properties": {
+                        "error_code": {"type": "integer"},
+                        "error_subcode": {"type": "integer"},
+                    }
+                },
+                "open": {
+                    "properties": {
+                        "peer_one": {"properties": open_properties},
+                        "peer_two": {"properties": open_properties},
+                    }
+                },
+                # Nested, so the fields of one route match together, not
+                # the MAC of one NLRI with the RD of another
+                "update": {"type": "nested", "properties": route_properties},
+                # Nested, so a filter on the subtype selects the value of
+                # that community (the MAC Mobility sequence number)
+                "extended_communities": {
+                    "type": "nested",
+                    "properties": {
+                        "type": {"type": "keyword"},
+                        "subtype": {"type": "keyword"},
+                        "2_bytes_value": dict(unindexed, type="long"),
+                        "4_bytes_value": {"type": "long"},
+                    }
+                },
+                "as_path": {"type": "long"},
+            }
+        },
+        "coalesced": {
+            "properties": {
+                "first_timestamp": {"type": "date"},
+                "last_timestamp": {"type": "date"},
+                "flips": {"type": "integer"},
+                "advertisements": {"type": "integer"},
+                "withdrawals": {"type": "integer"},
+                "final_state": {"type": "keyword"},
+            }
+        },
+    }
+}
+
+
+def policy(max_age="1d", max_size="10gb"):
+    return {
+        "policy": {
+            "phases": {
+                "hot": {
+                    "actions": {
+                        "rollover": {
+                            "max_age": max_age,
+                            "max_primary_shard_size": max_size
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+def template(alias, shards=1, replicas=0):
+    return {
+        "index_patterns": ["{}-*".format(alias)],
+        "template": {
+            "settings": {
+                "number_of_shards": shards,
+                "number_of_replicas": replicas,
+                # Documents arrive in bulk, searches can wait for a refresh
+                "refresh_interval": "5s",
+                "index.lifecycle.name": "{}-rollover".format(alias),
+                "index.lifecycle.rollover_alias": alias,
+            },
+            "mappings": mappings,
+        }
+    }
+
+
+def setup(es_url, alias, max_age="1d", max_size="10gb", shards=1,
+          replicas=0, session=requests):
+    """Install the policy and template of alias, and bootstrap its first
+    index unless the alias exists. Raises requests.RequestException when
+    Elasticsearch cannot be reached."""
+    es_url = es_url.rstrip("/")
+    response = session.put("{}/_ilm/policy/{}-rollover".format(es_url, alias),
+                           json=policy(max_age, max_size))
+    response.raise_for_status()
+    response = session.put("{}/_index_template/{}".format(es_url, alias),
+                           json=template(alias, shards, replicas))
+    response.raise_for_status()
+    if session.head("{}/_alias/{}".format(es_url, alias)).status_code == 200:
+        return
+    if session.head("{}/{}".format(es_url, alias)).status_code == 200:
+        log.warning("%s is an index and not an alias, documents go on being "
+                    "written to it without mappings or rollover", alias)
+        return
+    # One index per day, numbered on the rollovers within a day
+    first = urllib.parse.quote("<{}-{{now/d}}-000001>".format(alias), safe="")
+    response = session.put("{}/{}".format(es_url, first), json={
+        "aliases": {alias: {"is_write_index": True}}})
+    if response.status_code == 400 and \
+            "resource_already_exists" in response.text:
+        # Another listener created it first
+        return
+    response.raise_for_status()
@@ -0,0 +1,268 @@
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+import metrics
+import requests
+import serialization
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger("es_sink")
+
+# Per-item statuses worth sending again, anything else is a mapping or
+# document error that will fail the same way on every retry
+retryable_statuses = {429, 502, 503, 504}
+
+
+def retryable_request(status):
+    """Whether a bulk request failing as a whole with status is worth
+    sending again: throttling and server side errors, a 4xx is in the
+    request itself."""
+    return status in retryable_statuses or status >= 500
+
+
+class Checkpoint:
+    """Queued behind documents, its callback runs once they are indexed."""
+    __slots__ = ("callback",)
+
+    def __init__(self, callback):
+        self.callback = callback
+
+
+class BulkSink:
+    """Ships parsed documents to Elasticsearch through the _bulk API.
+
+    Parsed messages, or documents already encoded as bytes, are queued by
+    submit(), then encoded once to compact JSON, batched and sent by a
+    background thread over a pooled keep-alive session, so the parse path
+    never waits on an HTTP round trip. A batch is flushed once it holds
+    max_docs documents, max_bytes of NDJSON or is max_age seconds old.
+
+    At most max_queued documents wait for the worker, past that submit()
+    blocks, which stalls parsing and in turn the socket readers. With
+    block False submit() never blocks, the documents past max_queued are
+    kept back until drain() hands them to the worker, for callers on an
+    event loop that push back by other means.
+
+    Every request is bounded by timeout, a (connect, read) pair of seconds,
+    so a hung node counts as a failure and is retried like one. Failed
+    batches are retried max_retries times, forever if it is None, and then
+    dropped. A batch rejected as a whole (too large, malformed) is sent
+    again in halves down to the documents at fault, and the documents
+    Elasticsearch rejects are appended to the dead_letter file when one is
+    given. A checkpoint() callback runs once the documents submitted before
+    it are indexed or rejected, checkpoints are skipped once any document
+    has been dropped.
+    """
+
+    def __init__(self, es_url, index, max_docs=500, max_bytes=5 * 1024 * 1024,
+                 max_age=1.0, max_retries=5, pool_size=4, max_queued=50000,
+                 timeout=(5, 60), block=True, dead_letter=None):
+        self.url = "{}/_bulk".format(es_url.rstrip("/"))
+        self.action = json.dumps({"index": {"_index": index}}).encode() + b"\n"
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.dead_letter = dead_letter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.queue = queue.Queue(max_queued)
+        self.block = block
+        self.overflow = collections.deque()
+        self.overflow_lock = threading.Lock()
+        self.queue_high_water = 0
+        self.dropped = False
+        self.blocked = 0.0
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, message):
+        if not self.block:
+            with self.overflow_lock:
+                self.overflow.append(message)
+                self._drain()
+        else:
+            try:
+                self.queue.put_nowait(message)
+            except queue.Full:
+                began = time.monotonic()
+                self.queue.put(message)
+                self.blocked += time.monotonic() - began
+        queued = self.queue.qsize()
+        if queued > self.queue_high_water:
+            self.queue_high_water = queued
+
+    def report(self):
+        return "sink queue high-water {} docs, sink blocked {:.3f}s".format(
+            self.queue_high_water, self.blocked)
+
+    def drain(self):
+        """Queue the documents submit() kept back, True once none is
+        left."""
+        with self.overflow_lock:
+            return self._drain()
+
+    def _drain(self):
+        try:
+            while self.overflow:
+                self.queue.put_nowait(self.overflow[0])
+                self.overflow.popleft()
+        except queue.Full:
+            return False
+        return True
+
+    def checkpoint(self, callback):
+        # Behind the documents kept back as well
+        self.submit(Checkpoint(callback))
+
+    def stop_retrying(self):
+        """Drop failed batches from now on, for shutting down while
+        Elasticsearch is unreachable when documents can be sent again from a
+        checkpoint."""
+        self.max_retries = 0
+
+    def close(self):
+        with self.overflow_lock:
+            while self.overflow:
+                self.queue.put(self.overflow.popleft())
+        self.queue.put(None)
+        self.thread.join()
+        self.session.close()
+
+    def _worker(self):
+        batch = []
+        size = 0
+        deadline = None
+        # Checkpoints waiting for the batch being built to be sent
+        waiting = []
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                message = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                if self.overflow:
+                    # Room was made, the documents kept back go in behind
+                    self.drain()
+                if message is None:
+                    self._flush(batch)
+                    self._checkpoint(waiting)
+                    return
+                if isinstance(message, Checkpoint):
+                    if batch:
+                        waiting.append(message)
+                    else:
+                        self._checkpoint([message])
+                    continue
+                if isinstance(message, bytes):
+                    line = message
+                else:
+                    try:
+                        line = serialization.encode_message(message)
+                    except (TypeError, ValueError) as e:
+                        # One document that cannot be encoded is lost, not
+                        # the sink
+                        log.error("Dropping a document that cannot be "
+                                  "encoded: %r", e)
+                        metrics.es_errors.inc(labels=("encode",))
+                        continue
+                batch.append(line)
+                size += len(self.action) + len(line) + 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_age
+            if batch and (len(batch) >= self.max_docs or size >= self.max_bytes
+                          or time.monotonic() >= deadline):
+                self._flush(batch)
+                self._checkpoint(waiting)
+                batch = []
+                size = 0
+                deadline = None
+                waiting = []
+
+    def _checkpoint(self, checkpoints):
+        if self.dropped:
+            return
+        for checkpoint in checkpoints:
+            checkpoint.callback()
+
+    def _flush(self, batch):
+        attempt = 0
+        while batch:
+            failed = self._send(batch)
+            if not failed:
+                return
+            attempt += 1
+            if self.max_retries is not None and attempt > self.max_retries:
+                log.error("Dropping %d documents after %d retries",
+                          len(failed), attempt - 1)
+                metrics.es_errors.inc(len(failed), ("dropped",))
+                self.dropped = True
+                return
+            time.sleep(min(0.1 * 2 ** attempt, 10))
+            batch = failed
+
+    def _send(self, batch):
+        body = b"".join(self.action + line + b"\n" for line in batch)
+        began = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.url, data=body, timeout=self.timeout,
+                headers={"Content-Type": "application/x-ndjson"})
+        except requests.RequestException as e:
+            log.warning("Bulk request failed: %s", e)
+            metrics.es_errors.inc(labels=("request",))
+            return batch
+        finally:
+            metrics.es_request_seconds.observe(time.perf_counter() - began)
+        if retryable_request(response.status_code):
+            log.warning("Bulk request failed: %d %s", response.status_code,
+                        response.text[:200])
+            metrics.es_errors.inc(labels=("throttled",))
+            return batch
+        if response.status_code != 200:
+            # Would fail the same way again, narrowed down to the documents
+            # at fault instead
+            metrics.es_errors.inc(labels=("rejected",))
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                return self._send(batch[:middle]) + self._send(batch[middle:])
+            log.error("Document rejected, bulk request failed: %d %s",
+                      response.status_code, response.text[:200])
+            metrics.es_errors.inc(labels=("document_rejected",))
+            self._reject(batch)
+            return []
+        result = response.json()
+        if not result.get("errors"):
+            metrics.es_documents.inc(len(batch))
+            return []
+        failed = []
+        rejected = []
+        for line, item in zip(batch, result["items"]):
+            status = item["index"]["status"]
+            if status in retryable_statuses:
+                failed.append(line)
+            elif status >= 300:
+                log.warning("Document rejected: %s", item["index"].get("error"))
+                rejected.append(line)
+        metrics.es_documents.inc(len(batch) - len(failed) - len(rejected))
+        metrics.es_errors.inc(len(failed), ("document_throttled",))
+        metrics.es_errors.inc(len(rejected), ("document_rejected",))
+        self._reject(rejected)
+        return failed
+
+    def _reject(self, lines):
+        """Keep the documents Elasticsearch will never take in the dead
+        letter file, for a look and a manual resend."""
+        if self.dead_letter is None or not lines:
+            return
+        with open(self.dead_letter, "ab") as f:
+            f.writelines(line + b"\n" for line in lines)
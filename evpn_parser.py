@@ -1,124 +1,42 @@
+import collections
+import functools
+import logging
 import socket
 import struct
 import sys
-import json
-import requests
+import time
 import datetime
+import bmp_records
+import metrics
 
+log = logging.getLogger("evpn_parser")
 
-class MessageBuilder:
-
-    def __init__(self):
-        self.message = {}
-
-    def set_bmp_common(self, version, message_length, message_type):
-        self.message.update({"bmp_header": {}})
-        self.message["bmp_header"].update({
-            "bmp_version": version,
-            "message_length": message_length,
-            "message_type": message_type
-        })
-
-    def set_received_time(self):
-        self.message.update(
-            {"timestamp_received": datetime.datetime.now().isoformat()})
-
-    def set_bmp_per_peer(self, peer_type, flags, peer_distinguisher, address, asn, bgp_id, timestamp_sec, timestamp_msec):
-        self.message["bmp_header"].update({"per_peer_header": {}})
-        self.message["bmp_header"]["per_peer_header"].update({
-            "peer_type": peer_type,
-            "flags": flags,
-            "peer_distinguisher": peer_distinguisher,
-            "address": address,
-            "as_number": asn,
-            "bgp_id": bgp_id,
-            # "Timestamp (ms)": timestamp_msec
-        })
-        self.message.update({"timestamp_real": timestamp_sec})
-
-    def set_bmp_peer_up(self, local_address, local_port, remote_port):
-        self.message["bmp_header"].update({
-            "local_address": local_address,
-            "local_port": local_port,
-            "remote_port": remote_port
-        })
-
-    def set_bgp_basics(self, length, message_type):
-        self.message.update({"bgp_message": {}})
-        self.message["bgp_message"].update({
-            "message_type": message_type,
-            "length": length
-        })
-
-    def set_bgp_notification(self, error_code, error_subcode):
-        self.message["bgp_message"].update({"notification": {}})
-        self.message["bgp_message"]["notification"].update({
-            "error_code": error_code,
-            "error_subcode": error_subcode
-        })
-
-    def set_bgp_open(self, bgp_version, my_as, hold_time, bgp_identifier):
-        peer = None
-        if not "open" in self.message["bgp_message"]:
-            peer = "peer_one"
-            self.message["bgp_message"].update({"open": {"peer_one": {}}})
-        else:
-            peer = "peer_two"
-            self.message["bgp_message"]["open"].update({"peer_two": {}})
-        self.message["bgp_message"]["open"][peer].update({
-            "bgp_version": bgp_version,
-            "my_as": my_as,
-            "bgp_identifier": bgp_identifier,
-        })
-
-    def set_bgp_update(self):
-        self.message["bgp_message"].update({"update": []})
-
-    def set_bgp_nlri_mac(self, route_distinguisher, esi, ethernet_tag_id, mac_address, ip_address, mpls_label, nlri):
-        self.message["bgp_message"]["update"].append({
-            "evpn_route_type": "MAC Advertisement",
-            "type": "New Route" if nlri else "Withdrawn",
-            "route_distinguisher": route_distinguisher,
-            "esi": esi,
-            "ethernet_tag_id": ethernet_tag_id,
-            "mac_address": mac_address,
-            "ip_address": ip_address,
-            "mpls_label": mpls_label
-        })
-
-    def set_bgp_nlri_ip(self, route_distinguisher, esi, ethernet_tag_id, ip_prefix_length, ip_address, ip_gateway, mpls_label, nlri):
-        self.message["bgp_message"]["update"].append({
-            "evpn_route_type": "IP Prefix Route",
-            "type": "New Route" if nlri else "Withdrawn",
-            "route_distinguisher": route_distinguisher,
-            "esi": esi,
-            "ethernet_tag_id": ethernet_tag_id,
-            "ip_prefix_length": ip_prefix_length,
-            "ip_address": ip_address,
-            "ip_gateway": ip_gateway,
-            "mpls_label": mpls_label
-        })
-
-    def set_bgp_extended_community(self):
-        self.message["bgp_message"].update(
-            {"extended_communities": []})
-
-    def set_bgp_extended_community_entry(self, ec_type, ec_subtype, global_adm, local_adm):
-        self.message["bgp_message"]["extended_communities"].append({
-            "type": ec_type,
-            "subtype": ec_subtype,
-            "2_bytes_value": global_adm,
-            "4_bytes_value": local_adm
-        })
-
-    def set_as_path(self, segment):
-        self.message["bgp_message"].update({"as_path": segment})
-
-    def get_json(self):
-        return json.dumps(self.message, indent=2)
-
-
-marker = b'\xff' * 16
+
+class FramingError(Exception):
+    """The stream does not start with a valid BMP common header at offset,
+    everything before it was framed correctly."""
+
+    def __init__(self, offset):
+        super().__init__("Invalid BMP common header at offset {}".format(offset))
+        self.offset = offset
+
+
+# Fixed-layout headers, decoded in one unpack_from call each
+bmp_common_header = struct.Struct("!BIB")
+bmp_per_peer_header = struct.Struct("!BB8s16sI4sII")
+bmp_peer_up_header = struct.Struct("!16sHH")
+bgp_header = struct.Struct("!16sHB")
+bgp_open_header = struct.Struct("!BHH4sB")
+evpn_nlri_header = struct.Struct("!BB8s10sI")
+mp_reach_header = struct.Struct("!HBB")
+mp_unreach_header = struct.Struct("!HB")
+extended_community = struct.Struct("!BBHI")
+
+# What a truncated or inconsistent message raises while being decoded
+decode_errors = (IndexError, KeyError, ValueError, struct.error)
+
+bmp_common_header_length = bmp_common_header.size
+bgp_header_length = bgp_header.size
 
 bgp_message_type = {
     1:  "OPEN",
@@ -166,10 +84,17 @@ bmp_message_types = {
     6: "Route Mirroring Message",
 }
 
-single_length_path_attributes = {
-    "ORIGIN", "EXTENDED COMMUNITIES", "MULTI_EXIT_DISC", "COMMUNITY", "NEXT_HOP"}
-double_length_path_attributes = {
-    "MP_REACH_NLRI", "AS_PATH", "MP_UNREACH_NLRI", "CLUSTER_LIST"}
+# BMP messages that are followed by a per-peer header and a BGP PDU
+bgp_carrying_bmp_messages = {
+    "Route Monitoring", "Peer Up Notification", "Peer Down Notification"}
+# Peer Down reasons 1 and 3 carry the NOTIFICATION that closed the session
+peer_down_reasons_with_pdu = {1, 3}
+
+# Attribute flag telling the length field is two bytes instead of one
+extended_length_flag = 0x10
+evpn_afi_safi = (25, 70)
+# Metric label of an NLRI, by whether it came in MP_REACH or MP_UNREACH
+nlri_actions = {True: "reach", False: "withdraw"}
 
 evpn_route_types = {
     1: "Ethernet Autodiscovery",
@@ -183,7 +108,13 @@ evpn_route_types = {
 }
 
 bgp_notification_types = {
-    6: "Cease"
+    1: "Message Header Error",
+    2: "OPEN Message Error",
+    3: "UPDATE Message Error",
+    4: "Hold Timer Expired",
+    5: "Finite State Machine Error",
+    6: "Cease",
+    7: "ROUTE-REFRESH Message Error"
 }
 
 bgp_extended_communities_evpn_subtypes = {
@@ -257,45 +188,55 @@ bpd_extended_communities_types = {
 last_message = None
 
 
-def bytes_to_IP(num):
-    num = num.split(" ")
-    if len(num) == 4:
-        tmp = [str(int(x.replace("0x", ""), 16)) for x in num]
-        return ".".join(tmp)
-    if len(num) == 6:
-        tmp = [x.replace("0x", "") if len(x.replace("0x", ""))
-               == 2 else "0" + x.replace("0x", "") for x in num]
-        return ":".join(tmp)
-    if len(num) == 8:
-        tmp = [str(int(x.replace("0x", ""), 16)) for x in num]
-        return ".".join(tmp[2:-2]) + ":{}".format(str(tmp[-2]) + " " + str(tmp[-1]))
-    elif len(num) == 16:
-        tmp = []
-        for x in range(0, len(num), 2):
-            f = "0" + num[x].replace("0x", "") if len(num[x].replace("0x", "")
-                                                      ) == 1 else num[x].replace("0x", "")
-            s = "0" + num[x+1].replace("0x", "") if len(
-                num[x+1].replace("0x", "")) == 1 else num[x+1].replace("0x", "")
-            tmp.append("{}{}".format(f, s))
-        return ":".join(tmp)
+class RouteDistinguisher(collections.namedtuple(
+        "RouteDistinguisher", ["rd_type", "administrator", "assigned"])):
+    """RFC 4364 route distinguisher, printed as administrator:assigned."""
+
+    def __str__(self):
+        return "{}:{}".format(self.administrator, self.assigned)
+
+
+@functools.lru_cache(maxsize=4096)
+def decode_route_distinguisher(raw):
+    rd_type = int.from_bytes(raw[:2], byteorder='big')
+    if rd_type == 1:
+        administrator = socket.inet_ntop(socket.AF_INET, raw[2:6])
+        assigned = int.from_bytes(raw[6:], byteorder='big')
+    elif rd_type == 2:
+        administrator = int.from_bytes(raw[2:6], byteorder='big')
+        assigned = int.from_bytes(raw[6:], byteorder='big')
     else:
-        print("Unknown IP length")
+        # Type 0, and anything unknown rendered the same way
+        administrator = int.from_bytes(raw[2:4], byteorder='big')
+        assigned = int.from_bytes(raw[4:], byteorder='big')
+    return RouteDistinguisher(rd_type, administrator, assigned)
 
 
-def route_byte_repr(num):
-    ret = []
-    for x in num:
-        ret.append(hex(x))
-    return " ".join(ret)
+@functools.lru_cache(maxsize=65536)
+def decode_ip(raw):
+    if len(raw) == 4:
+        return socket.inet_ntop(socket.AF_INET, raw)
+    if len(raw) == 16:
+        return socket.inet_ntop(socket.AF_INET6, raw)
+    if raw:
+        log.warning("Unknown IP length %d", len(raw))
+    return None
 
 
-def pull_bytes(blob, pos, amount):
-    if amount > 0:
-        ret = route_byte_repr(blob[pos:pos+amount])
-        pos += amount
-        return ret, pos
-    else:
-        return None, pos
+def decode_mac(raw):
+    return raw.hex(":")
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_timestamp(seconds, microseconds=0):
+    timestamp = datetime.datetime.fromtimestamp(seconds)
+    if microseconds < 1000000:
+        timestamp = timestamp.replace(microsecond=microseconds)
+    return timestamp.isoformat()
+
+
+def pull_raw(blob, pos, amount):
+    return bytes(blob[pos:pos+amount]), pos + amount
 
 
 def pull_int(blob, pos, amount):
@@ -311,109 +252,100 @@ def pull_int(blob, pos, amount):
         return 0, pos
 
 
+def decode_address(address, flags):
+    # Address fields are always 16 bytes, IPv4 sits in the last 4
+    if flags >= 128:  # First bit set means IPv6
+        return decode_ip(address)
+    return decode_ip(address[12:])
+
+
 def parse_bmp_common_header(blob, pos, message):
-    begin = pos
-    version, pos = pull_int(blob, pos, 1)
-    message_length, pos = pull_int(blob, pos, 4)
-    message_type, pos = pull_int(blob, pos, 1)
-    if bmp_message_types[message_type] == "Initiation Message":
-        _, pos = pull_bytes(blob, pos, message_length - 6)
-        begin = pos
-        version, pos = pull_int(blob, pos, 1)
-        message_length, pos = pull_int(blob, pos, 4)
-        message_type, pos = pull_int(blob, pos, 1)
+    version, message_length, message_type = bmp_common_header.unpack_from(
+        blob, pos)
     message.set_bmp_common(version, message_length, message_type)
-    return pos, message_type, message_length, begin
+    return pos + bmp_common_header.size, message_type, message_length
 
 
 def parse_bmp_per_peer_header(blob, pos, message):
-    peer_type, pos = pull_int(blob, pos, 1)
-    flags, pos = pull_int(blob, pos, 1)
-    peer_distinguisher, pos = pull_bytes(blob, pos, 8)
-    if flags >= 128:  # First bit set means IPv6
-        address, pos = pull_bytes(blob, pos, 16)
-    else:
-        address, pos = pull_bytes(blob, pos, 4)
-    if address:
-        address = bytes_to_IP(address)
-    asn, pos = pull_int(blob, pos, 4)
-    bgp_id, pos = pull_bytes(blob, pos, 4)
-    if bgp_id:
-        bgp_id = bytes_to_IP(bgp_id)
-    timestamp_sec, pos = pull_int(blob, pos, 4)
-    timestamp_sec = datetime.datetime.fromtimestamp(timestamp_sec).isoformat()
-    timestamp_msec, pos = pull_int(blob, pos, 4)
-    message.set_bmp_per_peer(peer_type, flags, peer_distinguisher,
-                             address, asn, bgp_id, timestamp_sec, timestamp_msec)
+    (peer_type, flags, peer_distinguisher, address, asn, bgp_id,
+     timestamp_sec, timestamp_msec) = bmp_per_peer_header.unpack_from(blob, pos)
+    message.set_bmp_per_peer(peer_type, flags,
+                             decode_route_distinguisher(peer_distinguisher),
+                             decode_address(address, flags), asn,
+                             decode_ip(bgp_id),
+                             decode_timestamp(timestamp_sec, timestamp_msec),
+                             timestamp_msec)
+    return pos + bmp_per_peer_header.size, flags
 
 
 def parse_bmp_header(blob, message):
-    pos = 0
-    pos, message_type, message_length, begin = parse_bmp_common_header(
-        blob, pos, message)
-    if len(blob) > 6:  # Meaning there is a per-peer-header too
-        parse_bmp_per_peer_header(blob, pos, message)
+    pos, message_type, message_length = parse_bmp_common_header(
+        blob, 0, message)
+    if bmp_message_types.get(message_type) not in bgp_carrying_bmp_messages:
+        return None, message_type
+    pos, flags = parse_bmp_per_peer_header(blob, pos, message)
     if bmp_message_types[message_type] == "Peer Up Notification":
-        local_address, pos = pull_bytes(blob, pos, 16)
-        if local_address:
-            local_address = bytes_to_IP(local_address)
-        local_port, pos = pull_int(blob, pos, 2)
-        remote_port, pos = pull_int(blob, pos, 2)
-        message.set_bmp_peer_up(local_address, local_port, remote_port)
-    return message_length, begin, message_type
+        local_address, local_port, remote_port = bmp_peer_up_header.unpack_from(
+            blob, pos)
+        pos += bmp_peer_up_header.size
+        message.set_bmp_peer_up(decode_address(local_address, flags),
+                                local_port, remote_port)
+    elif bmp_message_types[message_type] == "Peer Down Notification":
+        reason, pos = pull_int(blob, pos, 1)
+        message.set_bmp_peer_down(reason)
+    return pos, message_type
 
 
 def extended_communities(blob, pos, length, message):
-    # print("Received Extended Community")
-    number_of_communities = int(length / 8)
     message.set_bgp_extended_community()
-    for _ in range(number_of_communities):
-        ec_type, pos = pull_int(blob, pos, 1)
-        ec_subtype, pos = pull_int(blob, pos, 1)
-        ec_type, subtype_class = bpd_extended_communities_types[ec_type]
+    for pos in range(pos, pos + length - 7, 8):
+        ec_type, ec_subtype, global_adm, local_adm = \
+            extended_community.unpack_from(blob, pos)
+        ec_type, subtype_class = bpd_extended_communities_types.get(
+            ec_type, (ec_type, None))
         if subtype_class:
-            ec_subtype = subtype_class[ec_subtype]
+            ec_subtype = subtype_class.get(ec_subtype, ec_subtype)
         else:
-            print("Subtype not recognized for EC type {}".format(ec_type))
-        global_adm, pos = pull_int(blob, pos, 2)
-        local_adm, pos = pull_int(blob, pos, 4)
+            log.debug("Subtype not recognized for EC type %s", ec_type)
         message.set_bgp_extended_community_entry(
             ec_type, ec_subtype, global_adm, local_adm)
-    return pos
 
 
 def as_path(blob, pos, length, message):
-    # print("AS Path")
     segment = []
-    segment_type, pos = pull_int(blob, pos, 1)
-    segment_len, pos = pull_int(blob, pos, 1)
-    for _ in range(segment_len):
-        asn, pos = pull_int(blob, pos, 4)
+    end = pos + length
+    while pos < end:
+        segment_type, pos = pull_int(blob, pos, 1)
+        segment_len, pos = pull_int(blob, pos, 1)
         if segment_type == 2:
-            segment.append(asn)
+            segment.extend(struct.unpack_from(
+                "!{}I".format(segment_len), blob, pos))
+        pos += 4 * segment_len
     message.set_as_path(segment)
-    return pos
 
 
-def mp_nlri(blob, pos, length, nlri, message):
+def mp_nlri(blob, pos, nlri, message):
     start_pos = pos
-    evpn_type, pos = pull_int(blob, pos, 1)
-    evpn_length, pos = pull_int(blob, pos, 1)
-    route_distinguisher, pos = pull_bytes(blob, pos, 8)
-    route_distinguisher = bytes_to_IP(route_distinguisher)
-    esi, pos = pull_int(blob, pos, 10)
-    ethernet_tag_id, pos = pull_int(blob, pos, 4)
+    if blob[pos] not in evpn_route_types:
+        # Skipped on its length, the other routes of the UPDATE are kept
+        metrics.parsed_routes.inc(labels=("unknown", nlri_actions[nlri]))
+        return start_pos + 2 + blob[pos + 1]
+    (evpn_type, evpn_length, route_distinguisher, esi,
+     ethernet_tag_id) = evpn_nlri_header.unpack_from(blob, pos)
+    pos += evpn_nlri_header.size
+    route_distinguisher = decode_route_distinguisher(route_distinguisher)
+    esi = int.from_bytes(esi, byteorder='big')
+    metrics.parsed_routes.inc(labels=(evpn_route_types[evpn_type],
+                                      nlri_actions[nlri]))
     if evpn_route_types[evpn_type] == "MAC Advertisement Route":
         # MAC length, assuming it is always 48-bits
         _, pos = pull_int(blob, pos, 1)
-        mac_address, pos = pull_bytes(blob, pos, 6)
-        if mac_address:
-            mac_address = bytes_to_IP(mac_address)
+        mac_address, pos = pull_raw(blob, pos, 6)
+        mac_address = decode_mac(mac_address)
         # IP length, and MPLS label
         ip_length, pos = pull_int(blob, pos, 1)
-        ip_address, pos = pull_bytes(blob, pos, int(ip_length / 8))
-        if ip_address:
-            ip_address = bytes_to_IP(ip_address)
+        ip_address, pos = pull_raw(blob, pos, int(ip_length / 8))
+        ip_address = decode_ip(ip_address)
         mpls_label = ""
         while pos-start_pos < (evpn_length + 2):
             label, pos = pull_int(blob, pos, 3)
@@ -424,16 +356,14 @@ def mp_nlri(blob, pos, length, nlri, message):
         # print("We have prefix route, left ",  evpn_length - 24)
         if evpn_length - 22 <= 12:
             ip_prefix_length, pos = pull_int(blob, pos, 1)
-            ip_address, pos = pull_bytes(blob, pos, 4)
-            ip_address = bytes_to_IP(ip_address)
-            ip_gateway, pos = pull_bytes(blob, pos, 4)
-            ip_gateway = bytes_to_IP(ip_gateway)
+            ip_address, pos = pull_raw(blob, pos, 4)
+            ip_gateway, pos = pull_raw(blob, pos, 4)
         else:
             ip_prefix_length, pos = pull_int(blob, pos, 1)
-            ip_address, pos = pull_bytes(blob, pos, 16)
-            ip_address = bytes_to_IP(ip_address)
-            ip_gateway, pos = pull_bytes(blob, pos, 16)
-            ip_gateway = bytes_to_IP(ip_gateway)
+            ip_address, pos = pull_raw(blob, pos, 16)
+            ip_gateway, pos = pull_raw(blob, pos, 16)
+        ip_address = decode_ip(ip_address)
+        ip_gateway = decode_ip(ip_gateway)
         mpls_label = ""
         while pos-start_pos < (evpn_length + 2):
             label, pos = pull_int(blob, pos, 3)
@@ -441,148 +371,190 @@ def mp_nlri(blob, pos, length, nlri, message):
         message.set_bgp_nlri_ip(
             route_distinguisher, esi, ethernet_tag_id, ip_prefix_length, ip_address, ip_gateway, mpls_label, nlri)
     else:
-        print("Unsupported advertisement type: {}".format(
-            evpn_route_types[evpn_type]))
-        # Return pointer to next path attribute (minus bytes we already consumed)
-        return pos + length - 4
+        log.info("Unsupported advertisement type: %s",
+                 evpn_route_types[evpn_type])
+        # Skip to the next NLRI
+        return start_pos + 2 + evpn_length
     return pos
 
 
+def mp_reach_nlri(blob, pos, length, message):
+    end = pos + length
+    afi, safi, next_hop_length = mp_reach_header.unpack_from(blob, pos)
+    if (afi, safi) != evpn_afi_safi:
+        return
+    pos += mp_reach_header.size
+    # A 32 bytes next hop is a global and a link-local IPv6 address
+    next_hop, pos = pull_raw(blob, pos, next_hop_length)
+    message.set_bgp_next_hop(decode_ip(next_hop[:16]))
+    pos += 1  # Reserved (SNPA) byte
+    while pos < end:
+        pos = mp_nlri(blob, pos, True, message)
+
+
+def mp_unreach_nlri(blob, pos, length, message):
+    end = pos + length
+    afi, safi = mp_unreach_header.unpack_from(blob, pos)
+    if (afi, safi) != evpn_afi_safi:
+        return
+    pos += mp_unreach_header.size
+    while pos < end:
+        pos = mp_nlri(blob, pos, False, message)
+
+
+# Decoders by path attribute type code, everything else is skipped by length
+path_attribute_decoders = {
+    2: as_path,
+    14: mp_reach_nlri,
+    15: mp_unreach_nlri,
+    16: extended_communities,
+}
+
+
 def parse_path_attribute(blob, pos, message):
-    _, pos = pull_int(blob, pos, 1)
-    path_attribute_type, pos = pull_int(blob, pos, 1)
-    if bgp_path_attributes[path_attribute_type] in single_length_path_attributes:
-        length, pos = pull_int(blob, pos, 1)
-    elif bgp_path_attributes[path_attribute_type] in double_length_path_attributes:
-        length, pos = pull_int(blob, pos, 2)
-    else:
-        print("Unkown length attribute",
-              bgp_path_attributes[path_attribute_type])
-        exit()
-    remainder = length
-    if bgp_path_attributes[path_attribute_type] == "MP_REACH_NLRI":
-        afi, pos = pull_int(blob, pos, 2)
-        safi, pos = pull_int(blob, pos, 1)
-        if afi != 25 or safi != 70:
-            # Return pointer to next path attribute (minus bytes we already consumed)
-            return pos + length - 3
-        # Network Address of Next Hop, is it really always 5-bytes in our case?
-        _, pos = pull_int(blob, pos, 5)
-        # SNPA, is it really always 1-bytes in our case?
-        _, pos = pull_int(blob, pos, 1)
-        remainder -= 9
-        while remainder:
-            old_pos = pos
-            pos = mp_nlri(blob, pos, length, True, message)
-            remainder -= (pos - old_pos)
-    elif bgp_path_attributes[path_attribute_type] == "MP_UNREACH_NLRI":
-        afi, pos = pull_int(blob, pos, 2)
-        safi, pos = pull_int(blob, pos, 1)
-        remainder -= 3
-        if afi != 25 or safi != 70:
-            # Return pointer to next path attribute (minus bytes we already consumed)
-            return pos + length - 3
-        while remainder:
-            old_pos = pos
-            pos = mp_nlri(blob, pos, length, False, message)
-            remainder -= (pos - old_pos)
-    elif bgp_path_attributes[path_attribute_type] == "EXTENDED COMMUNITIES":
-        pos = extended_communities(blob, pos, length, message)
-    elif bgp_path_attributes[path_attribute_type] == "AS_PATH":
-        pos = as_path(blob, pos, length, message)
+    flags = blob[pos]
+    path_attribute_type = blob[pos+1]
+    if flags & extended_length_flag:
+        length = int.from_bytes(blob[pos+2:pos+4], byteorder='big')
+        pos += 4
     else:
-        pos += length  # Return pointer to next path attribute
-    return pos
+        length = blob[pos+2]
+        pos += 3
+    decoder = path_attribute_decoders.get(path_attribute_type)
+    if decoder is not None:
+        decoder(blob, pos, length, message)
+    return pos + length  # Pointer to next path attribute
 
 
 def update(blob, pos, message):
-    print("Received Update")
     message.set_bgp_update()
-    _, pos = pull_int(blob, pos, 2)
+    withdrawn_routes_length, pos = pull_int(blob, pos, 2)
+    pos += withdrawn_routes_length  # Only EVPN routes, carried in MP_*_NLRI
     path_attributes_length, pos = pull_int(blob, pos, 2)
-    drawn = 0
-    while(drawn < path_attributes_length):
-        new_pos = parse_path_attribute(blob, pos, message)
-        drawn += new_pos - pos
-        pos = new_pos
+    end = pos + path_attributes_length
+    while pos < end:
+        pos = parse_path_attribute(blob, pos, message)
     return pos
 
 
 def notification(blob, pos, message):
-    print("Received Notification")
     error_code, pos = pull_int(blob, pos, 1)
     error_subcode, pos = pull_int(blob, pos, 1)
-    if bgp_notification_types[error_code] == "Cease":
-        message.set_bgp_notification(error_code, error_subcode)
-    else:
-        print("NOTIFICATION RECEIVED, unsupported type {}".format(error_code))
+    # Kept whatever the code, the document carries it raw
+    message.set_bgp_notification(error_code, error_subcode)
+    log.debug("NOTIFICATION %s (%d), subcode %d",
+              bgp_notification_types.get(error_code, "Unknown"), error_code,
+              error_subcode)
     return pos
 
 
 def open_m(blob, pos, message):
-    print("Received Open")
-    bgp_version, pos = pull_int(blob, pos, 1)
-    my_as, pos = pull_int(blob, pos, 2)
-    hold_time, pos = pull_int(blob, pos, 2)
-    bgp_identifier, pos = pull_bytes(blob, pos, 4)
-    bgp_identifier = bytes_to_IP(bgp_identifier)
-    optional_parameters_length, pos = pull_int(blob, pos, 1)
-    pos += optional_parameters_length  # Skipping parameters for now
+    (bgp_version, my_as, hold_time, bgp_identifier,
+     optional_parameters_length) = bgp_open_header.unpack_from(blob, pos)
+    bgp_identifier = decode_ip(bgp_identifier)
+    # Skipping parameters for now
+    pos += bgp_open_header.size + optional_parameters_length
     message.set_bgp_open(bgp_version, my_as, hold_time, bgp_identifier)
     return pos
 
 
-def run(blob, index):
+def next_frame(blob, pos):
+    """Return the complete BMP message starting at pos, and the offset of the
+    one after it, or (None, pos) if it has not been fully received yet.
+
+    Framing only relies on the message_length of the common header, the
+    returned frame is a slice of blob so a memoryview is never copied.
+    """
+    if len(blob) - pos < bmp_common_header_length:
+        return None, pos
+    version, message_length, _ = bmp_common_header.unpack_from(blob, pos)
+    if version != 3 or message_length < bmp_common_header_length:
+        raise FramingError(pos)
+    if len(blob) - pos < message_length:
+        return None, pos
+    return blob[pos:pos+message_length], pos + message_length
+
+
+def parse_message(frame):
+    """Decode one framed BMP message, None if it carries nothing to index or
+    is malformed."""
+    began = time.perf_counter()
+    try:
+        return decode_message(frame)
+    except decode_errors as e:
+        # One bad message must not stop the stream, framing is unaffected
+        log.warning("Skipping undecodable message: %r", e)
+        metrics.undecodable_messages.inc()
+        return None
+    finally:
+        metrics.parse_seconds.observe(time.perf_counter() - began)
+
+
+def decode_message(frame):
+    message = bmp_records.BMPMessage()
+    message.set_received_time()
+    pos, bmp_type = parse_bmp_header(frame, message)
+    if pos is None:
+        metrics.parsed_messages.inc(labels=(
+            bmp_message_types.get(bmp_type, bmp_type), ""))
+        if bmp_message_types.get(bmp_type) == "Termination Message":
+            # The router ends the session, its peers are gone with it
+            return message
+        return None
+    if message.peer_down_reason is not None and \
+            message.peer_down_reason not in peer_down_reasons_with_pdu:
+        # Closed without a NOTIFICATION, the per-peer header says which peer
+        metrics.parsed_messages.inc(labels=(bmp_message_types[bmp_type], ""))
+        return message
+    bgp_begin = pos
+    _, message_length, message_type = bgp_header.unpack_from(frame, pos)
+    pos += bgp_header.size
+    metrics.parsed_messages.inc(labels=(
+        bmp_message_types[bmp_type], bgp_message_type.get(message_type, message_type)))
+    message.set_bgp_basics(
+        message_length, bgp_message_type[message_type])
+    if bgp_message_type[message_type] == "UPDATE":
+        update(frame, pos, message)
+    elif bgp_message_type[message_type] == "NOTIFICATION":
+        notification(frame, pos, message)
+    elif bgp_message_type[message_type] == "OPEN":
+        open_m(frame, pos, message)
+        # Peer Up carries the received OPEN right after the sent one
+        pos = bgp_begin + message_length + bgp_header_length
+        open_m(frame, pos, message)
+    else:
+        log.info("Unsupported message: %s", bgp_message_type[message_type])
+        return None
+    return message
+
+
+def run(blob, emit, message_filter=None, router=None):
+    """Parse every complete BMP message in blob, passing each decoded
+    message to emit, and return the number of bytes consumed. Messages
+    rejected by message_filter are skipped without being decoded. The
+    messages framed are counted against router when it is given."""
     global last_message
-    success = True
     pos = 0
-    new_start = 0
-    while(blob.find(marker, 0) != -1):
-        roll_back = pos
-        pos = blob.find(marker, 0)
-        tmp = pos
-        _, pos = pull_int(blob, pos, 16)
-        try:
-            message_length, pos = pull_int(blob, pos, 2)
-            if len(blob) < roll_back + message_length:
-                raise Exception()
-        except:
-            return new_start
-        message = MessageBuilder()
-        message.set_received_time()
-        message_type, pos = pull_int(blob, pos, 1)
-        message.set_bgp_basics(
-            message_length, bgp_message_type[message_type])
-        total_length, bmp_begin, _ = parse_bmp_header(
-            blob[:tmp], message)
-        if bgp_message_type[message_type] == "UPDATE":
-            pos = update(blob, pos, message)
-        elif bgp_message_type[message_type] == "NOTIFICATION":
-            pos = notification(blob, pos, message)
-        elif bgp_message_type[message_type] == "OPEN":
-            if len(blob) < pos + total_length:
-                return new_start
-            pos = open_m(blob, pos, message)
-            _, pos = pull_int(blob, pos, 19)
-            pos = open_m(blob, pos, message)
-            _, pos = pull_bytes(blob, pos, (total_length - bmp_begin) - pos)
-        else:
-            print("Unsupported message, ", bgp_message_type[message_type])
-            success = False
-        new_start += pos
-        blob = blob[pos:]
-        if __name__ == "__main__":
-            print(message.get_json())
-        elif success:
-            print("Pushing JSON")
-            last_message = message
-            requests.post("http://localhost:9200/{}/_doc".format(index),
-                          json=message.message)
-    return new_start
+    frames = 0
+    while True:
+        frame, next_pos = next_frame(blob, pos)
+        if frame is None:
+            if router is not None:
+                metrics.received_messages.inc(frames, (router,))
+            return pos
+        pos = next_pos
+        frames += 1
+        if message_filter is not None and not message_filter.accepts(frame):
+            continue
+        message = parse_message(frame)
+        if message is None:
+            continue
+        last_message = message
+        emit(message)
 
 
 if __name__ == "__main__":
     f = open(sys.argv[1], "rb")
     blob = f.read()
     f.close()
-    run(blob, "")
+    run(blob, lambda message: print(message.get_json()))
@@ -1,120 +1,441 @@
+import argparse
+import asyncio
+import coalesce
+import es_index
+import es_sink
 import evpn_parser
+import functools
+import logging
+import message_filter
+import metrics
 import os
+import parser_pool
 import requests
-import selectors
+import rib
 import signal
-import socket
-import sys
-import threading
-import types
-from queue import Queue
+import spool
+import time
 
-lock = threading.Lock()
-sock = None
-blob = b''
+log = logging.getLogger("listen")
 
 
-def cleanup(sig, frame):
-    global sock
+class ReceiveBuffer:
+    """Growable per-connection receive buffer.
+
+    The event loop reads straight into the free tail of a bytearray (see
+    get_buffer) and the parser is handed a memoryview over the unread region,
+    so consuming a message only advances the read offset.
+    """
+
+    def __init__(self, addr, size=65536):
+        self.addr = addr
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _make_room(self, wanted):
+        pending = self.end - self.start
+        if self.start:
+            # Move the unread tail to the front, only pending bytes are copied
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if len(self.buf) - self.end < wanted:
+            self.buf.extend(bytes(max(len(self.buf), wanted)))
+
+    def get_buffer(self, amount=8912):
+        if len(self.buf) - self.end < amount:
+            self._make_room(amount)
+        return memoryview(self.buf)[self.end:self.end + amount]
+
+    def buffer_updated(self, received):
+        self.end += received
+
+    def view(self):
+        return memoryview(self.buf)[self.start:self.end]
+
+    def consume(self, amount):
+        self.start += amount
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+def parse_buffer(data, emit, message_filter=None):
+    view = data.view()
     try:
-        sock.shutdown()
-        sock.close()
-    except:
-        pass
+        consumed = evpn_parser.run(view, emit, message_filter, data.addr[0])
     finally:
-        os._exit(0)
-
-
-def accept_wrapper(sock, sel):
-    conn, addr = sock.accept()  # Should be ready to read
-    print('accepted connection from', addr)
-    conn.setblocking(False)
-    data = types.SimpleNamespace(addr=addr, inb=b'', outb=b'')
-    events = selectors.EVENT_READ
-    sel.register(conn, events, data=data)
-
-
-def service_connection(key, mask, sel):
-    global blob
-    sock = key.fileobj
-    data = key.data
-    if mask & selectors.EVENT_READ:
-        recv_data = sock.recv(8912)  # Should be ready to read
-        if recv_data:
-            with lock:
-                blob = blob + recv_data
-        else:
-            print('closing connection to', data.addr)
-            sel.unregister(sock)
-            sock.close()
+        view.release()
+    data.consume(consumed)
+    return consumed
+
+
+def spool_buffer(data, frames, message_filter=None):
+    """Append every complete message buffered for a connection to the
+    spool with the time it arrived, without decoding it."""
+    pos = 0
+    framed = 0
+    arrived = time.time()
+    view = data.view()
+    try:
+        while True:
+            frame, next_pos = evpn_parser.next_frame(view, pos)
+            if frame is None:
+                break
+            pos = next_pos
+            framed += 1
+            if message_filter is None or message_filter.accepts(frame):
+                frames.append(frame, arrived)
+    finally:
+        view.release()
+    frames.flush()
+    data.consume(pos)
+    metrics.received_messages.inc(framed, (data.addr[0],))
+    return pos
+
+
+class PipelineStats:
+    """High-water marks and blocked time of the ingest pipeline, used to
+    size the backlog limits of a deployment."""
+
+    def __init__(self):
+        self.backlog_high_water = 0
+        self.paused_connections = 0
+        self.pauses = 0
+        self.reading_blocked = 0.0
+
+    def observe_backlog(self, backlog):
+        if backlog > self.backlog_high_water:
+            self.backlog_high_water = backlog
+
+    def report(self, *stages):
+        line = ("backlog high-water {} bytes, {} pauses, {} paused now, "
+                "reading blocked {:.3f}s").format(
+            self.backlog_high_water, self.pauses, self.paused_connections,
+            self.reading_blocked)
+        return ", ".join([line] + [stage.report() for stage in stages])
+
+
+class BMPProtocol(asyncio.BufferedProtocol):
+    """One instance per router connection.
+
+    The event loop writes received bytes directly into the connection's
+    ReceiveBuffer and queues the connection for the parser task. Once
+    max_backlog unparsed bytes are buffered the connection stops reading, so
+    TCP flow control pushes back on the router until the parser catches up.
+
+    Parsing runs on the event loop and hands documents downstream without
+    blocking. When downstream is full the connection parsed last is held,
+    not reading, until it takes what was kept back.
+    """
+
+    def __init__(self, ready, stats, max_backlog, connections, closed=None):
+        self.ready = ready
+        self.connections = connections
+        self.closed = closed
+        self.stats = stats
+        self.max_backlog = max_backlog
+        self.transport = None
+        self.data = None
+        self.scheduled = False
+        self.paused_at = None
+        self.held_at = None
+        self.lost = False
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info('peername')
+        log.info("accepted connection from %s", addr)
+        self.transport = transport
+        self.data = ReceiveBuffer(addr)
+        self.connections.add(self)
+
+    def get_buffer(self, sizehint):
+        return self.data.get_buffer()
 
+    def buffer_updated(self, nbytes):
+        self.data.buffer_updated(nbytes)
+        metrics.received_bytes.inc(nbytes, (self.data.addr[0],))
+        self.stats.observe_backlog(len(self.data))
+        if len(self.data) >= self.max_backlog and self.paused_at is None:
+            self.transport.pause_reading()
+            self.paused_at = time.monotonic()
+            self.stats.pauses += 1
+            self.stats.paused_connections += 1
+        if not self.scheduled:
+            self.scheduled = True
+            self.ready.put_nowait(self)
 
-def listen(host, port):
-    global sock
-    sel = selectors.DefaultSelector()
-    sel.register(sock, selectors.EVENT_READ, data=None)
+    def parse(self, process):
+        self.scheduled = False
+        try:
+            process(self.data)
+        except evpn_parser.FramingError as e:
+            # Nothing to resynchronise on, the router will reconnect
+            log.error("%s from %s", e, self.data.addr)
+            self.transport.abort()
+        except Exception:
+            # A full disk under the spool, say, costs this connection only
+            log.exception("Could not process the data of %s, closing the "
+                          "connection", self.data.addr)
+            self.transport.abort()
+        if self.paused_at is not None and len(self.data) < self.max_backlog // 2:
+            self.stats.reading_blocked += time.monotonic() - self.paused_at
+            self.stats.paused_connections -= 1
+            self.paused_at = None
+            self.transport.resume_reading()
+        if self.lost:
+            self._closed()
+
+    def hold(self):
+        """Stop reading until release(), downstream is full."""
+        self.transport.pause_reading()
+        self.held_at = time.monotonic()
+        self.stats.pauses += 1
+
+    def release(self):
+        self.stats.reading_blocked += time.monotonic() - self.held_at
+        self.held_at = None
+        if self.paused_at is None:
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        log.info("closing connection to %s", self.data.addr)
+        self.connections.discard(self)
+        if self.paused_at is not None:
+            self.stats.paused_connections -= 1
+            self.paused_at = None
+        self.lost = True
+        if not self.scheduled:
+            self._closed()
+
+    def _closed(self):
+        # After the last parse of the connection
+        if self.closed is not None:
+            self.closed(self.data.addr)
+
+
+async def parse_connections(ready, process, drain=None, retry=0.01):
+    """Parse the connections as they are ready. drain() hands downstream
+    what it had no room for, True once all of it is taken."""
     while True:
-        events = sel.select(timeout=None)
-        for key, mask in events:
-            if key.data is None:
-                accept_wrapper(key.fileobj, sel)
-            else:
-                service_connection(key, mask, sel)
-
-
-def parse(index):
-    global blob
-    global lock
-    to_parse = b''
+        protocol = await ready.get()
+        protocol.parse(process)
+        if drain is None or drain():
+            continue
+        protocol.hold()
+        while not drain():
+            await asyncio.sleep(retry)
+        protocol.release()
+
+
+async def report_stats(stats, stages, interval):
     while True:
-        if len(blob) != 0:
-            print(len(blob))
-        with lock:
-            if blob:
-                to_parse = to_parse + blob
-                blob = b''
-        if len(to_parse) > 128:
-            print("Starting parse run")
-            consumed = evpn_parser.run(to_parse, index)
-            to_parse = to_parse[consumed:]
-            print("Consumed: {}".format(consumed))
+        await asyncio.sleep(interval)
+        log.info(stats.report(*stages))
+
+
+def backlog_by_router(connections):
+    backlog = {}
+    for protocol in list(connections):
+        router = (protocol.data.addr[0],)
+        backlog[router] = backlog.get(router, 0) + len(protocol.data)
+    return backlog
+
+
+async def listen(host, port, process, stages, max_backlog, stats_interval=60,
+                 drain=None, closed=None):
+    """Serve BMP connections until SIGINT/SIGTERM. process(data) consumes
+    what is buffered for a connection without blocking, drain() hands on
+    what it kept back (see parse_connections), closed(addr) is called once
+    a connection is closed and parsed. stages are the downstream objects
+    (filter, BulkSink, ParserPool) whose report() is included in the
+    pipeline reports."""
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Queue()
+    stats = PipelineStats()
+    connections = set()
+    metrics.backlog_bytes.function = lambda: backlog_by_router(connections)
+    server = await loop.create_server(
+        lambda: BMPProtocol(ready, stats, max_backlog, connections, closed),
+        host, port, reuse_address=True)
+    log.info("listening on %s", (host, port))
+    tasks = [asyncio.create_task(parse_connections(ready, process, drain))]
+    if stats_interval:
+        tasks.append(asyncio.create_task(
+            report_stats(stats, stages, stats_interval)))
+    stop = loop.create_future()
+
+    def request_stop():
+        # A second signal while shutting down changes nothing
+        if not stop.done():
+            stop.set_result(None)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_stop)
+    async with server:
+        await stop
+    for task in tasks:
+        task.cancel()
+    log.info(stats.report(*stages))
 
 
 if __name__ == "__main__":
-    host = sys.argv[1]
-    port = int(sys.argv[2])
-    index = "port{}".format(port)
-    if len(sys.argv) > 3:
-        index = sys.argv[3]
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((host, port))
-    sock.listen()
-    sock.setblocking(False)
-    print('listening on', (host, port))
-
-    signal.signal(signal.SIGINT, cleanup)
-    signal.signal(signal.SIGTERM, cleanup)
-
-    requests.put(
-        "http://localhost:9200/{}?pretty".format(index), json={
-            "mappings": {
-                "_default_": {
-                    "_timestamp": {
-                        "enabled": True,
-                        "store": True
-                    }
-                }
-            }
-
-        })
-
-    l = threading.Thread(target=listen, args=(host, port))
-    l.daemon = True
-    l.start()
-    p = threading.Thread(target=parse, args=(index,))
-    p.daemon = True
-    p.start()
-    for t in [l, p]:
-        t.join()
+    parser = argparse.ArgumentParser(
+        description="Collect EVPN routes from BMP feeds into Elasticsearch")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("index", nargs="?",
+                        help="Elasticsearch alias written to, port<PORT> by "
+                        "default")
+    parser.add_argument("--es-url", default="http://localhost:9200")
+    parser.add_argument("--rollover-age", default="1d",
+                        help="start a new index behind the alias after this "
+                        "long")
+    parser.add_argument("--rollover-size", default="10gb",
+                        help="or once a primary shard reaches this size")
+    parser.add_argument("--bulk-docs", type=int, default=500,
+                        help="flush a bulk request after this many documents")
+    parser.add_argument("--bulk-bytes", type=int, default=5 * 1024 * 1024,
+                        help="flush a bulk request after this many bytes")
+    parser.add_argument("--bulk-age", type=float, default=1.0,
+                        help="flush a bulk request after this many seconds")
+    parser.add_argument("--max-backlog", type=int, default=4 * 1024 * 1024,
+                        help="stop reading a connection once this many "
+                        "unparsed bytes are buffered for it")
+    parser.add_argument("--max-queued-docs", type=int, default=50000,
+                        help="stop reading once this many documents wait "
+                        "for Elasticsearch")
+    parser.add_argument("--stats-interval", type=float, default=60,
+                        help="seconds between pipeline reports, 0 disables")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="parse in this many worker processes instead of "
+                        "in the listener")
+    parser.add_argument("--shard-by", choices=["connection", "peer"],
+                        default="connection",
+                        help="how messages are assigned to workers")
+    parser.add_argument("--metrics-port", type=int, default=9108,
+                        help="serve Prometheus metrics on this port, 0 "
+                        "disables; worker N uses the port + N")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-sample", type=int, default=100,
+                        help="log only one in this many repeats of a message")
+    parser.add_argument("--spool",
+                        help="spool received messages to this directory and "
+                        "index them from there, so reading never waits on "
+                        "Elasticsearch")
+    parser.add_argument("--spool-segment-size", type=int,
+                        default=64 * 1024 * 1024)
+    parser.add_argument("--dead-letter",
+                        help="append the documents Elasticsearch rejects to "
+                        "this file, dead_letter.ndjson in the spool "
+                        "directory by default with --spool")
+    parser.add_argument("--rib", action="store_true",
+                        help="keep a live Adj-RIB-In of every peer, queried "
+                        "under /rib/ on the metrics port")
+    parser.add_argument("--coalesce-window", type=float, default=0,
+                        help="fold the updates of a route that follow its "
+                        "first one within this many seconds into a summary "
+                        "document, 0 disables")
+    message_filter.add_arguments(parser)
+    args = parser.parse_args()
+    if args.spool and args.workers:
+        parser.error("--spool and --workers cannot be combined")
+    index = args.index or "port{}".format(args.port)
+    metrics.setup_logging(args.log_level, args.log_sample)
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port, args.metrics_host)
+
+    try:
+        es_index.setup(args.es_url, index, args.rollover_age,
+                       args.rollover_size)
+    except requests.RequestException as e:
+        # Documents wait in the sink (or the spool) until it is reachable
+        log.warning("Could not set up index %s: %s", index, e)
+
+    sink_args = (args.es_url, index)
+    sink_kwargs = {"max_docs": args.bulk_docs, "max_bytes": args.bulk_bytes,
+                   "max_age": args.bulk_age, "max_queued": args.max_queued_docs,
+                   "dead_letter": args.dead_letter}
+    if args.spool and args.dead_letter is None:
+        sink_kwargs["dead_letter"] = os.path.join(args.spool,
+                                                  "dead_letter.ndjson")
+    selection = message_filter.from_arguments(args)
+    drain = None
+    closed = None
+    if args.workers:
+        stage = parser_pool.ParserPool(
+            args.workers, sink_args, sink_kwargs, args.shard_by,
+            message_filter=selection,
+            metrics_address=(args.metrics_host, args.metrics_port)
+            if args.metrics_port else None, keep_rib=args.rib,
+            coalesce_window=args.coalesce_window)
+        process = stage.dispatch
+        drain = stage.drain
+        if args.rib:
+            closed = stage.close_connection
+        stages = [stage]
+    else:
+        if args.spool:
+            # Everything is on disk, never give up on a batch
+            sink_kwargs["max_retries"] = None
+        else:
+            # Parsed on the event loop, which must not wait on the sink
+            sink_kwargs["block"] = False
+        stage = es_sink.BulkSink(*sink_args, **sink_kwargs)
+        stages = [stage]
+        if not args.spool:
+            drain = stage.drain
+        if args.coalesce_window:
+            stage = coalesce.Coalescer(stage, args.coalesce_window)
+            stages.append(stage)
+        emit = stage.submit
+        if args.rib:
+            adj_rib = rib.Rib()
+            metrics.endpoints["rib"] = adj_rib.http_query
+            stages.append(adj_rib)
+
+            def emit(message, connection=None):
+                adj_rib.apply(message, connection)
+                stage.submit(message)
+
+            if not args.spool:
+                # The spool keeps no connection, its peers are flushed by
+                # Peer Up and Peer Down only
+                closed = adj_rib.close_connection
+
+        if args.spool:
+            frames = spool.Spool(args.spool, args.spool_segment_size)
+            consumer = spool.SpoolConsumer(frames, stage, emit)
+            metrics.spool_pending_bytes.function = lambda: {(): frames.pending()}
+            stages.insert(0, frames)
+
+            def process(data):
+                return spool_buffer(data, frames, selection)
+        elif args.rib:
+            def process(data):
+                return parse_buffer(data, functools.partial(
+                    emit, connection=data.addr), selection)
+        else:
+            def process(data):
+                return parse_buffer(data, emit, selection)
+    if selection is not None:
+        stages.insert(0, selection)
+    try:
+        asyncio.run(listen(args.host, args.port, process, stages,
+                           args.max_backlog, args.stats_interval, drain,
+                           closed))
+    finally:
+        if args.spool:
+            consumer.close()
+        stage.close()
+        if args.spool:
+            frames.close()
+            log.info(frames.report())
@@ -0,0 +1,186 @@
+import argparse
+import socket
+import evpn_parser
+
+mp_reach_nlri = 14
+mp_unreach_nlri = 15
+
+
+def _codes(values, table):
+    """Turn a list of names or numbers into the set of codes of table."""
+    if not values:
+        return None
+    by_name = {name.upper(): code for code, name in table.items()}
+    codes = set()
+    for value in values:
+        if str(value).isdigit():
+            codes.add(int(value))
+        elif str(value).upper() in by_name:
+            codes.add(by_name[str(value).upper()])
+        else:
+            raise ValueError("unknown type {!r}, expected one of {}".format(
+                value, ", ".join(table.values())))
+    return codes
+
+
+def _names(table):
+    """argparse type of a comma separated list of names or numbers of
+    table, unknown names are reported as usage errors."""
+    def parse(text):
+        values = text.split(",")
+        try:
+            _codes(values, table)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        return values
+    return parse
+
+
+def _raw_address(address):
+    if ":" in address:
+        return socket.inet_pton(socket.AF_INET6, address)
+    return bytes(12) + socket.inet_pton(socket.AF_INET, address)
+
+
+class MessageFilter:
+    """Decides from fixed-offset fields whether a framed BMP message is worth
+    decoding, without decoding it.
+
+    Every criterion left to None accepts everything. bmp_types and bgp_types
+    match the message types, peers and peer_distinguishers the per-peer
+    header. afi_safi and route_types only apply to UPDATEs: one of their
+    MP_REACH/MP_UNREACH attributes must carry a matching AFI/SAFI, and for
+    EVPN one matching route type, for the UPDATE to be accepted.
+    """
+
+    def __init__(self, bmp_types=None, bgp_types=None, afi_safi=None,
+                 route_types=None, peers=None, peer_distinguishers=None):
+        self.bmp_types = _codes(bmp_types, evpn_parser.bmp_message_types)
+        self.bgp_types = _codes(bgp_types, evpn_parser.bgp_message_type)
+        self.route_types = _codes(route_types, evpn_parser.evpn_route_types)
+        self.afi_safi = set(afi_safi) if afi_safi else None
+        self.peers = {_raw_address(peer) for peer in peers} if peers else None
+        self.peer_distinguishers = (set(peer_distinguishers)
+                                    if peer_distinguishers else None)
+        self.accepted = 0
+        self.rejected = 0
+
+    def accepts(self, frame):
+        try:
+            accepted = self._accepts(frame)
+        except IndexError:
+            # Truncated or malformed, left to the decoder to report
+            accepted = True
+        if accepted:
+            self.accepted += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def _accepts(self, frame):
+        bmp_type = frame[5]
+        if self.bmp_types is not None and bmp_type not in self.bmp_types:
+            return False
+        if evpn_parser.bmp_message_types.get(bmp_type) not in \
+                evpn_parser.bgp_carrying_bmp_messages:
+            # Nothing past the common header is decoded anyway
+            return True
+        pos = evpn_parser.bmp_common_header.size
+        if self.peers is not None and \
+                bytes(frame[pos+10:pos+26]) not in self.peers:
+            return False
+        if self.peer_distinguishers is not None and str(
+                evpn_parser.decode_route_distinguisher(
+                    bytes(frame[pos+2:pos+10]))) not in self.peer_distinguishers:
+            return False
+        if self.bgp_types is None and self.afi_safi is None and \
+                self.route_types is None:
+            return True
+        pos += evpn_parser.bmp_per_peer_header.size
+        if evpn_parser.bmp_message_types[bmp_type] == "Peer Up Notification":
+            pos += evpn_parser.bmp_peer_up_header.size
+        elif evpn_parser.bmp_message_types[bmp_type] == "Peer Down Notification":
+            pos += 1
+        if len(frame) < pos + evpn_parser.bgp_header.size:
+            return True
+        bgp_type = frame[pos+18]
+        if self.bgp_types is not None and bgp_type not in self.bgp_types:
+            return False
+        if evpn_parser.bgp_message_type.get(bgp_type) != "UPDATE" or (
+                self.afi_safi is None and self.route_types is None):
+            return True
+        return self._update_matches(frame, pos + evpn_parser.bgp_header.size)
+
+    def _update_matches(self, frame, pos):
+        withdrawn_length = int.from_bytes(frame[pos:pos+2], byteorder='big')
+        pos += 2 + withdrawn_length
+        end = pos + 2 + int.from_bytes(frame[pos:pos+2], byteorder='big')
+        pos += 2
+        while pos < end:
+            flags = frame[pos]
+            attribute_type = frame[pos+1]
+            if flags & evpn_parser.extended_length_flag:
+                length = int.from_bytes(frame[pos+2:pos+4], byteorder='big')
+                pos += 4
+            else:
+                length = frame[pos+2]
+                pos += 3
+            if attribute_type in (mp_reach_nlri, mp_unreach_nlri) and \
+                    self._mp_matches(frame, pos, pos + length, attribute_type):
+                return True
+            pos += length
+        return False
+
+    def _mp_matches(self, frame, pos, end, attribute_type):
+        afi_safi = (int.from_bytes(frame[pos:pos+2], byteorder='big'),
+                    frame[pos+2])
+        if self.afi_safi is not None and afi_safi not in self.afi_safi:
+            return False
+        if self.route_types is None:
+            return True
+        if afi_safi != evpn_parser.evpn_afi_safi:
+            return False
+        pos += 3
+        if attribute_type == mp_reach_nlri:
+            # Next hop, then the reserved byte
+            pos += 1 + frame[pos] + 1
+        while pos < end:
+            if frame[pos] in self.route_types:
+                return True
+            pos += 2 + frame[pos+1]
+        return False
+
+    def report(self):
+        return "filter accepted {} rejected {}".format(
+            self.accepted, self.rejected)
+
+
+def add_arguments(parser):
+    parser.add_argument("--bmp-types",
+                        type=_names(evpn_parser.bmp_message_types),
+                        help="only decode these BMP message types")
+    parser.add_argument("--bgp-types",
+                        type=_names(evpn_parser.bgp_message_type),
+                        help="only decode these BGP message types, "
+                        "e.g. OPEN,UPDATE,NOTIFICATION")
+    parser.add_argument("--afi-safi", action="append",
+                        type=lambda s: tuple(int(x) for x in s.split("/")),
+                        help="only decode UPDATEs for this AFI/SAFI, "
+                        "e.g. 25/70, can be repeated")
+    parser.add_argument("--route-types",
+                        type=_names(evpn_parser.evpn_route_types),
+                        help="only decode UPDATEs carrying these EVPN route "
+                        "types, e.g. 2,5")
+    parser.add_argument("--peers", type=lambda s: s.split(","),
+                        help="only decode messages of these peer addresses")
+    parser.add_argument("--peer-distinguishers", type=lambda s: s.split(","),
+                        help="only decode messages of these peer "
+                        "distinguishers")
+
+
+def from_arguments(args):
+    criteria = (args.bmp_types, args.bgp_types, args.afi_safi,
+                args.route_types, args.peers, args.peer_distinguishers)
+    if not any(criteria):
+        return None
+    return MessageFilter(*criteria)
@@ -0,0 +1,222 @@
+"""In-process metrics, exposed in the Prometheus text format.
+
+Metrics are plain counters, gauges and histograms kept in a registry, cheap
+enough to update on the parse path. start_http_server() serves the registry
+on /metrics, and any JSON endpoints registered, from a daemon thread.
+setup_logging() configures level-controlled logging where repeated messages
+are sampled instead of flooding the output.
+"""
+import bisect
+import http.server
+import logging
+import threading
+import urllib.parse
+import serialization
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+
+    def header(self):
+        return "# HELP {0} {1}\n# TYPE {0} {2}\n".format(
+            self.name, self.description, self.kind)
+
+    def labels_text(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                              for k, v in pairs) + "}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        super().__init__(name, description, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        return self.header() + "".join(
+            "{}{} {}\n".format(self.name, self.labels_text(labels), value)
+            for labels, value in list(self.values.items()))
+
+
+class Gauge(Metric):
+    """Gauge read from a function at scrape time, the function returns a
+    {labels: value} dict so nothing is updated on the hot path."""
+    kind = "gauge"
+
+    def __init__(self, name, description, labelnames=(), function=None):
+        super().__init__(name, description, labelnames)
+        self.function = function
+
+    def render(self):
+        values = self.function() if self.function is not None else {}
+        return self.header() + "".join(
+            "{}{} {}\n".format(self.name, self.labels_text(labels), value)
+            for labels, value in values.items())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets, labelnames=()):
+        super().__init__(name, description, labelnames)
+        self.buckets = list(buckets)
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def render(self):
+        lines = [self.header()]
+        for labels, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}\n".format(
+                    self.name, self.labels_text(labels, [("le", bound)]),
+                    cumulative))
+            lines.append("{}_sum{} {}\n".format(
+                self.name, self.labels_text(labels), total))
+            lines.append("{}_count{} {}\n".format(
+                self.name, self.labels_text(labels), cumulative))
+        return "".join(lines)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "".join(metric.render() for metric in self.metrics)
+
+
+registry = Registry()
+
+latency_buckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.5, 1, 5)
+
+received_bytes = registry.register(Counter(
+    "bmp_received_bytes_total", "Bytes received per router",
+    ("router",)))
+received_messages = registry.register(Counter(
+    "bmp_received_messages_total", "BMP messages framed per router",
+    ("router",)))
+parsed_messages = registry.register(Counter(
+    "bmp_parsed_messages_total", "Decoded messages per BMP and BGP type",
+    ("bmp_type", "bgp_type")))
+parsed_routes = registry.register(Counter(
+    "evpn_parsed_routes_total", "Decoded EVPN NLRIs per route type",
+    ("route_type", "action")))
+undecodable_messages = registry.register(Counter(
+    "bmp_undecodable_messages_total", "Messages skipped because they could "
+    "not be decoded"))
+parse_seconds = registry.register(Histogram(
+    "bmp_parse_seconds", "Time spent decoding one BMP message",
+    latency_buckets))
+backlog_bytes = registry.register(Gauge(
+    "bmp_backlog_bytes", "Unparsed bytes buffered per router",
+    ("router",)))
+spool_pending_bytes = registry.register(Gauge(
+    "spool_pending_bytes", "Bytes spooled to disk and not indexed yet"))
+coalesced_updates = registry.register(Counter(
+    "evpn_coalesced_updates_total", "Route updates folded by the flap "
+    "coalescer, and summaries sent for them", ("kind",)))
+es_request_seconds = registry.register(Histogram(
+    "es_bulk_request_seconds", "Latency of Elasticsearch _bulk requests",
+    latency_buckets))
+es_documents = registry.register(Counter(
+    "es_documents_total", "Documents indexed in Elasticsearch"))
+es_errors = registry.register(Counter(
+    "es_errors_total", "Failed Elasticsearch requests and documents",
+    ("kind",)))
+
+
+# Other JSON endpoints served next to /metrics, by first path component.
+# The function gets the rest of the path and returns None when not found.
+endpoints = {}
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = urllib.parse.unquote(self.path.split("?")[0])
+        if path in ("/", "/metrics"):
+            self.respond(registry.render().encode(),
+                         "text/plain; version=0.0.4")
+            return
+        name, _, rest = path.lstrip("/").partition("/")
+        result = None
+        if name in endpoints:
+            try:
+                result = endpoints[name](rest)
+            except ValueError:
+                pass
+        if result is None:
+            self.send_error(404)
+            return
+        self.respond(serialization.dumps(result), "application/json")
+
+    def respond(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class SampleFilter(logging.Filter):
+    """Lets through the first and then one in every `every` records logged
+    with the same format string, so a recurring warning cannot flood."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.seen = {}
+
+    def filter(self, record):
+        seen = self.seen.get(record.msg, 0)
+        self.seen[record.msg] = seen + 1
+        if seen % self.every:
+            return False
+        if seen:
+            record.msg = "{} (seen {} times)".format(record.msg, seen + 1)
+        return True
+
+
+def setup_logging(level="INFO", sample=100):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    if sample > 1:
+        handler.addFilter(SampleFilter(sample))
+    logging.basicConfig(level=level, handlers=[handler])
@@ -0,0 +1,179 @@
+import collections
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+import zlib
+import coalesce
+import es_sink
+import evpn_parser
+import metrics
+import rib
+
+log = logging.getLogger("parser_pool")
+
+# Distinguisher and address of the per-peer header, the peer type and flags
+# differ between the pre and post-policy messages of a peer
+peer_key_slice = slice(8, 32)
+
+
+def worker(frames, sink_args, sink_kwargs, metrics_address=None,
+           keep_rib=False, coalesce_window=0):
+    # Shutdown is driven by the listener through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    adj_rib = None
+    if keep_rib:
+        adj_rib = rib.Rib()
+        metrics.endpoints["rib"] = adj_rib.http_query
+    if metrics_address is not None:
+        metrics.start_http_server(metrics_address[1], metrics_address[0])
+    sink = es_sink.BulkSink(*sink_args, **sink_kwargs)
+    if coalesce_window:
+        sink = coalesce.Coalescer(sink, coalesce_window)
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        connection, batch = item
+        if batch is None:
+            # The connection is closed
+            if adj_rib is not None:
+                adj_rib.close_connection(connection)
+            continue
+        for frame in batch:
+            message = evpn_parser.parse_message(frame)
+            if message is not None:
+                if adj_rib is not None:
+                    adj_rib.apply(message, connection)
+                sink.submit(message)
+    sink.close()
+    if coalesce_window:
+        log.info(sink.report())
+        sink = sink.sink
+    log.info("parser worker done, %s", sink.report())
+    if adj_rib is not None:
+        log.info(adj_rib.report())
+
+
+class ParserPool:
+    """Parses framed BMP messages in worker processes.
+
+    The listener only frames (and optionally filters) the stream, whole
+    messages are sent to the
+    worker chosen by connection or by peer (per-peer header address and
+    distinguisher), so messages of one peer are always parsed in order by the
+    same process. Each worker ships its documents through its own BulkSink.
+
+    Parse and Elasticsearch metrics live in the workers: with metrics_address
+    (host, port) worker N serves its own on port + N, the listener keeps the
+    per-connection ones. With keep_rib every worker keeps the RIB of the
+    peers sharded to it, queried on its own metrics port, and
+    close_connection() flushes the peers of a closed connection. A
+    coalesce_window folds route flaps in every worker, before its sink.
+
+    dispatch() never blocks: batches for a worker whose queue is full are
+    kept back, in order, until drain() gets them in.
+    """
+
+    def __init__(self, workers, sink_args, sink_kwargs, shard_by="connection",
+                 max_batches=64, message_filter=None, metrics_address=None,
+                 keep_rib=False, coalesce_window=0):
+        self.shard_by = shard_by
+        self.message_filter = message_filter
+        self.queues = []
+        self.pending = []
+        self.processes = []
+        self.pending_high_water = 0
+        for number in range(workers):
+            frames = multiprocessing.Queue(max_batches)
+            worker_metrics = None
+            if metrics_address is not None:
+                worker_metrics = (metrics_address[0],
+                                  metrics_address[1] + number + 1)
+            process = multiprocessing.Process(
+                target=worker,
+                args=(frames, sink_args, sink_kwargs, worker_metrics,
+                      keep_rib, coalesce_window),
+                daemon=True)
+            process.start()
+            self.queues.append(frames)
+            self.pending.append(collections.deque())
+            self.processes.append(process)
+
+    def shard(self, addr, frame):
+        if self.shard_by == "peer" and len(frame) >= peer_key_slice.stop:
+            return zlib.crc32(frame[peer_key_slice]) % len(self.queues)
+        # The router, whatever source port it reconnects from
+        return hash(addr[0]) % len(self.queues)
+
+    def dispatch(self, data):
+        """Frame everything buffered for a connection and queue the messages
+        to their workers, returns the number of bytes consumed."""
+        batches = {}
+        pos = 0
+        framed = 0
+        view = data.view()
+        try:
+            while True:
+                frame, next_pos = evpn_parser.next_frame(view, pos)
+                if frame is None:
+                    break
+                pos = next_pos
+                framed += 1
+                if self.message_filter is not None and \
+                        not self.message_filter.accepts(frame):
+                    continue
+                batches.setdefault(self.shard(data.addr, frame), []).append(
+                    bytes(frame))
+        finally:
+            view.release()
+        data.consume(pos)
+        metrics.received_messages.inc(framed, (data.addr[0],))
+        for shard, batch in batches.items():
+            self.submit(shard, (data.addr, batch))
+        return pos
+
+    def close_connection(self, addr):
+        if self.shard_by == "peer":
+            shards = range(len(self.queues))
+        else:
+            shards = [self.shard(addr, b"")]
+        for shard in shards:
+            self.submit(shard, (addr, None))
+
+    def submit(self, shard, batch):
+        pending = self.pending[shard]
+        pending.append(batch)
+        if not self._drain(shard) and \
+                len(pending) > self.pending_high_water:
+            self.pending_high_water = len(pending)
+
+    def drain(self):
+        """Queue the batches kept back, True once none is left."""
+        done = True
+        for shard in range(len(self.queues)):
+            done = self._drain(shard) and done
+        return done
+
+    def _drain(self, shard):
+        pending = self.pending[shard]
+        try:
+            while pending:
+                self.queues[shard].put_nowait(pending[0])
+                pending.popleft()
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        for frames, pending in zip(self.queues, self.pending):
+            while pending:
+                frames.put(pending.popleft())
+            frames.put(None)
+        for process in self.processes:
+            process.join()
+
+    def report(self):
+        return "{} workers, kept back high-water {} batches".format(
+            len(self.processes), self.pending_high_water)
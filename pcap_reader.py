@@ -0,0 +1,424 @@
+"""Streaming pcap and pcapng reader for captured BMP sessions.
+
+Packets are read one at a time, the capture is never loaded whole. The TCP
+flows to the BMP port are reassembled: segments are delivered in sequence
+order, retransmitted and overlapping data is trimmed, out-of-order segments
+wait until the gap before them is filled. Each flow is fed to the parser as
+its own stream, with the capture time as the received timestamp:
+
+    python pcap_reader.py capture.pcapng --port 11019 --output docs.ndjson
+
+Captures starting in the middle of a session, or losing segments, are
+resynchronised on the next plausible chain of BMP headers.
+"""
+import argparse
+import datetime
+import logging
+import struct
+import sys
+import time
+import evpn_parser
+import message_filter
+import replay
+import serialization
+
+log = logging.getLogger("pcap_reader")
+
+pcap_magics = {
+    0xa1b2c3d4: 1e-6,
+    0xa1b23c4d: 1e-9,
+}
+pcapng_section_header = 0x0a0d0d0a
+pcapng_byte_order = 0x1a2b3c4d
+pcapng_interface = 1
+pcapng_simple_packet = 3
+pcapng_enhanced_packet = 6
+
+# Link types
+linktype_null = 0
+linktype_ethernet = 1
+linktype_raw = 101
+linktype_linux_sll = 113
+linktype_linux_sll2 = 276
+linktype_ipv4 = 228
+linktype_ipv6 = 229
+
+ethertype_ipv4 = 0x0800
+ethertype_ipv6 = 0x86dd
+ethertype_vlans = {0x8100, 0x88a8, 0x9100}
+ipv6_extension_headers = {0, 43, 60}
+tcp_protocol = 6
+
+tcp_fin = 0x01
+tcp_syn = 0x02
+tcp_rst = 0x04
+
+# Bytes of out-of-order data kept per flow before giving up on a gap, more
+# than a receive window so only lost segments end up skipped
+max_pending_bytes = 8 * 1024 * 1024
+# Longest BMP message believed when resynchronising on a header
+max_message_length = 1 << 17
+
+
+def read_pcap(f, magic_bytes):
+    order = "<" if struct.unpack("<I", magic_bytes)[0] in pcap_magics else ">"
+    resolution = pcap_magics[struct.unpack(order + "I", magic_bytes)[0]]
+    header = f.read(20)
+    linktype = struct.unpack(order + "HHiIII", header)[5] & 0x0fffffff
+    record = struct.Struct(order + "IIII")
+    while True:
+        raw = f.read(record.size)
+        if len(raw) < record.size:
+            return
+        seconds, fraction, captured, _ = record.unpack(raw)
+        data = f.read(captured)
+        if len(data) < captured:
+            return
+        yield seconds + fraction * resolution, linktype, data
+
+
+def read_pcapng(f, first):
+    order = "<"
+    interfaces = []
+    block_type_raw = first
+    while True:
+        raw = block_type_raw + f.read(4) if block_type_raw else f.read(8)
+        block_type_raw = None
+        if len(raw) < 8:
+            return
+        block_type = struct.unpack(order + "I", raw[:4])[0]
+        if block_type == pcapng_section_header:
+            # The byte order magic comes right after the length
+            magic = f.read(4)
+            order = "<" if struct.unpack("<I", magic)[0] == pcapng_byte_order \
+                else ">"
+            length = struct.unpack(order + "I", raw[4:])[0]
+            f.read(length - 12)
+            interfaces = []
+            continue
+        length = struct.unpack(order + "I", raw[4:])[0]
+        body = f.read(length - 8)
+        if len(body) < length - 8:
+            return
+        if block_type == pcapng_interface:
+            linktype = struct.unpack_from(order + "H", body)[0]
+            interfaces.append([linktype, 1e-6])
+            # if_tsresol option, code 9
+            pos = 8
+            while pos + 4 <= len(body) - 4:
+                code, option_length = struct.unpack_from(order + "HH", body, pos)
+                if code == 0:
+                    break
+                if code == 9:
+                    value = body[pos + 4]
+                    interfaces[-1][1] = (2 ** -(value & 0x7f) if value & 0x80
+                                         else 10 ** -value)
+                pos += 4 + (option_length + 3) // 4 * 4
+        elif block_type == pcapng_enhanced_packet:
+            interface, high, low, captured, _ = struct.unpack_from(
+                order + "IIIII", body)
+            linktype, resolution = interfaces[interface]
+            yield ((high << 32 | low) * resolution, linktype,
+                   body[20:20 + captured])
+        elif block_type == pcapng_simple_packet:
+            linktype, _ = interfaces[0]
+            original = struct.unpack_from(order + "I", body)[0]
+            yield None, linktype, body[4:4 + original]
+
+
+def read_packets(f):
+    """Yield (timestamp, linktype, frame) for every packet of a pcap or
+    pcapng file object."""
+    magic = f.read(4)
+    if len(magic) < 4:
+        return iter(())
+    if struct.unpack("<I", magic)[0] == pcapng_section_header:
+        return read_pcapng(f, magic)
+    if struct.unpack("<I", magic)[0] in pcap_magics or \
+            struct.unpack(">I", magic)[0] in pcap_magics:
+        return read_pcap(f, magic)
+    raise ValueError("Not a pcap or pcapng file")
+
+
+def network_layer(linktype, frame):
+    """Return (ethertype, offset) of the network header in frame."""
+    if linktype == linktype_ethernet:
+        ethertype = int.from_bytes(frame[12:14], "big")
+        pos = 14
+        while ethertype in ethertype_vlans:
+            ethertype = int.from_bytes(frame[pos + 2:pos + 4], "big")
+            pos += 4
+        return ethertype, pos
+    if linktype == linktype_linux_sll:
+        return int.from_bytes(frame[14:16], "big"), 16
+    if linktype == linktype_linux_sll2:
+        return int.from_bytes(frame[0:2], "big"), 20
+    if linktype in (linktype_raw, linktype_ipv4, linktype_ipv6):
+        return (ethertype_ipv6 if frame and frame[0] >> 4 == 6
+                else ethertype_ipv4), 0
+    if linktype == linktype_null:
+        # Address family in host order, 2 is IPv4, anything else taken as IPv6
+        family = max(frame[0], frame[3]) if len(frame) >= 4 else 2
+        return (ethertype_ipv4 if family == 2 else ethertype_ipv6), 4
+    return None, None
+
+
+def decode_tcp(linktype, frame):
+    """Return (flow, seq, flags, payload) of a TCP packet, None otherwise.
+    flow is (source, source port, destination, destination port)."""
+    ethertype, pos = network_layer(linktype, frame)
+    if ethertype == ethertype_ipv4:
+        if len(frame) < pos + 20:
+            return None
+        header_length = (frame[pos] & 0x0f) * 4
+        total_length = int.from_bytes(frame[pos + 2:pos + 4], "big")
+        fragment = int.from_bytes(frame[pos + 6:pos + 8], "big")
+        if frame[pos + 9] != tcp_protocol or fragment & 0x3fff:
+            # Not TCP, or a fragment, which BMP sessions do not produce
+            return None
+        source = frame[pos + 12:pos + 16]
+        destination = frame[pos + 16:pos + 20]
+        # Captured before TCP segmentation offload, the length can be 0
+        end = pos + total_length if total_length else len(frame)
+        pos += header_length
+    elif ethertype == ethertype_ipv6:
+        if len(frame) < pos + 40:
+            return None
+        next_header = frame[pos + 6]
+        end = pos + 40 + int.from_bytes(frame[pos + 4:pos + 6], "big")
+        source = frame[pos + 8:pos + 24]
+        destination = frame[pos + 24:pos + 40]
+        pos += 40
+        while next_header in ipv6_extension_headers:
+            next_header = frame[pos]
+            pos += (frame[pos + 1] + 1) * 8
+        if next_header != tcp_protocol:
+            return None
+    else:
+        return None
+    if len(frame) < pos + 20:
+        return None
+    source_port, destination_port, seq = struct.unpack_from("!HHI", frame, pos)
+    flags = frame[pos + 13]
+    payload = frame[pos + (frame[pos + 12] >> 4) * 4:end]
+    return (source, source_port, destination, destination_port), seq, flags, \
+        payload
+
+
+def sequence_delta(seq, reference):
+    """seq - reference, with 32 bits sequence number wraparound."""
+    return (seq - reference + (1 << 31)) % (1 << 32) - (1 << 31)
+
+
+class TcpStream:
+    """One direction of a TCP flow, reassembled in sequence order."""
+
+    def __init__(self):
+        self.next_seq = None
+        self.pending = {}
+        self.pending_bytes = 0
+        self.retransmitted = 0
+        self.gaps = 0
+
+    def segment(self, seq, flags, payload):
+        """Return the bytes this segment makes deliverable, in order, and
+        whether data was lost before them."""
+        if flags & tcp_syn:
+            self.next_seq = (seq + 1) % (1 << 32)
+            seq = self.next_seq
+        if not payload:
+            return b"", False
+        if self.next_seq is None:
+            # Joined in the middle of the session
+            self.next_seq = seq
+        delta = sequence_delta(seq, self.next_seq)
+        if delta > 0:
+            if len(payload) > len(self.pending.get(seq, b"")):
+                self.pending_bytes += len(payload) - len(
+                    self.pending.get(seq, b""))
+                self.pending[seq] = payload
+            if self.pending_bytes > max_pending_bytes:
+                return self._skip_gap(), True
+            return b"", False
+        if -delta >= len(payload):
+            self.retransmitted += 1
+            return b"", False
+        chunks = [payload[-delta:]]
+        self.next_seq = (self.next_seq + len(payload) + delta) % (1 << 32)
+        chunks.extend(self._drain())
+        return b"".join(chunks), False
+
+    def _drain(self):
+        while self.pending:
+            seq = self.next_seq
+            if seq not in self.pending:
+                # A held segment may overlap the data just delivered
+                seq = next((held for held in self.pending
+                            if sequence_delta(held, self.next_seq) <= 0), None)
+                if seq is None:
+                    return
+            payload = self.pending.pop(seq)
+            self.pending_bytes -= len(payload)
+            delta = sequence_delta(seq, self.next_seq)
+            if -delta < len(payload):
+                self.next_seq = (self.next_seq + len(payload) + delta) \
+                    % (1 << 32)
+                yield payload[-delta:]
+
+    def finish(self):
+        """Deliver what is still held at the end of the flow, the chunks
+        each come after missing data."""
+        chunks = []
+        while self.pending:
+            chunks.append(self._skip_gap())
+        return chunks
+
+    def _skip_gap(self):
+        """Give up on the missing data, continue from the first segment
+        held."""
+        self.gaps += 1
+        self.next_seq = min(self.pending, key=lambda seq: sequence_delta(
+            seq, self.next_seq))
+        return b"".join(self._drain())
+
+
+def plausible_header(blob, pos):
+    if len(blob) - pos < evpn_parser.bmp_common_header.size:
+        return False
+    version, length, message_type = \
+        evpn_parser.bmp_common_header.unpack_from(blob, pos)
+    return (version == 3 and message_type in evpn_parser.bmp_message_types
+            and evpn_parser.bmp_common_header.size <= length
+            <= max_message_length)
+
+
+def resynchronise(blob):
+    """Offset of the first message of blob followed by another plausible
+    header, None if more data is needed to tell."""
+    pos = blob.find(b"\x03")
+    while pos != -1:
+        if plausible_header(blob, pos):
+            following = pos + int.from_bytes(blob[pos + 1:pos + 5], "big")
+            if following + evpn_parser.bmp_common_header.size > len(blob):
+                return None
+            if plausible_header(blob, following):
+                return pos
+        pos = blob.find(b"\x03", pos + 1)
+    return None
+
+
+class Session:
+    """Receive buffer of one reassembled flow."""
+
+    def __init__(self, synchronised):
+        self.stream = TcpStream()
+        self.buffer = bytearray()
+        self.synchronised = synchronised
+
+    def feed(self, data, gap, emit, selection):
+        if gap:
+            self.buffer.clear()
+            self.synchronised = False
+        self.buffer += data
+        if not self.synchronised:
+            start = resynchronise(self.buffer)
+            if start is None:
+                if len(self.buffer) > max_pending_bytes:
+                    self.buffer.clear()
+                return
+            del self.buffer[:start]
+            self.synchronised = True
+        view = memoryview(self.buffer)
+        try:
+            consumed = evpn_parser.run(view, emit, selection)
+        except evpn_parser.FramingError as e:
+            log.warning("%s, resynchronising", e)
+            consumed = e.offset + 1
+            self.synchronised = False
+        finally:
+            view.release()
+        del self.buffer[:consumed]
+
+
+class CaptureReader:
+    """Reassembles the TCP flows to port (every flow if None) of a capture
+    and parses them, see read()."""
+
+    def __init__(self, port=None, selection=None):
+        self.port = port
+        self.selection = selection
+        self.sessions = {}
+        self.packets = 0
+        self.bytes = 0
+        self.flows = 0
+
+    def read(self, f, emit):
+        """Parse the capture file object f, passing every message to emit
+        with the capture time of its last segment as timestamp_received."""
+        timestamp = None
+
+        def stamped(message):
+            if timestamp is not None:
+                message.timestamp_received = \
+                    datetime.datetime.fromtimestamp(timestamp)
+            emit(message)
+
+        for timestamp, linktype, frame in read_packets(f):
+            self.packets += 1
+            self.bytes += len(frame)
+            packet = decode_tcp(linktype, frame)
+            if packet is None:
+                continue
+            flow, seq, flags, payload = packet
+            if self.port is not None and flow[3] != self.port:
+                continue
+            session = self.sessions.get(flow)
+            if session is None or flags & tcp_syn:
+                session = self.sessions[flow] = Session(bool(flags & tcp_syn))
+                self.flows += 1
+            data, gap = session.stream.segment(seq, flags, payload)
+            if data or gap:
+                session.feed(data, gap, stamped, self.selection)
+            if flags & (tcp_fin | tcp_rst):
+                self._finish(self.sessions.pop(flow), stamped)
+        for session in self.sessions.values():
+            self._finish(session, stamped)
+        self.sessions.clear()
+
+    def _finish(self, session, emit):
+        for data in session.stream.finish():
+            session.feed(data, True, emit, self.selection)
+
+    def report(self):
+        return "{} packets, {} bytes, {} flows".format(
+            self.packets, self.bytes, self.flows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse the BMP sessions of "
+                                     "a pcap or pcapng capture")
+    parser.add_argument("capture")
+    parser.add_argument("--port", type=int,
+                        help="BMP collector port, every TCP flow by default")
+    replay.add_sink_arguments(parser)
+    message_filter.add_arguments(parser)
+    args = parser.parse_args()
+    sink = replay.make_sink(args)
+    reader = CaptureReader(args.port, message_filter.from_arguments(args))
+    messages = 0
+
+    def emit(message):
+        global messages
+        messages += 1
+        sink.submit(serialization.encode_message(message))
+
+    began = time.perf_counter()
+    try:
+        with open(args.capture, "rb", buffering=1024 * 1024) as f:
+            reader.read(f, emit)
+    finally:
+        sink.close()
+    elapsed = time.perf_counter() - began
+    print("{}, {} messages in {:.1f}s, {:.1f} MB/s".format(
+        reader.report(), messages, elapsed, reader.bytes / elapsed / 1e6),
+        file=sys.stderr)
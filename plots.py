@@ -1,6 +1,7 @@
 import sys
+import os
+import datetime
 import requests
-import json
 import dateutil.parser
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
@@ -8,10 +9,11 @@ import matplotlib.ticker as mticker
 from matplotlib.colors import ListedColormap
 import matplotlib
 import math
+import multiprocessing
 import numpy
-import statistics
 import networkx as nx
 import hashlib
+import update_cache
 
 es_host = None
 es_port = None
@@ -20,13 +22,28 @@ target = None
 
 tolerance = 1
 
+# Hits fetched per search_after page, and how long the point in time is kept
+# open between two pages
+page_size = 5000
+keep_alive = "1m"
+session = requests.Session()
+# search.max_buckets of the cluster, the most buckets one search may return
+max_buckets = 65536
+
+# UPDATEs are cached locally, one file per index, see update_cache
+cache_directory = "cache"
+rebuild_cache = False
+
+# Processes finding the events of the MACs, 1 finds them in this one
+workers = 1
+
 nlri_possibilities = ["MP_NLRI_REACH", "MP_NLRI_UNREACH"]
 
 rd_to_anycast = {
-    "10.10.10.1:0 6": "10.10.100.1",
-    "10.10.10.2:0 6": "10.10.100.1",
-    "10.10.10.3:0 6": "10.10.100.2",
-    "10.10.10.4:0 6": "10.10.100.2",
+    "10.10.10.1:6": "10.10.100.1",
+    "10.10.10.2:6": "10.10.100.1",
+    "10.10.10.3:6": "10.10.100.2",
+    "10.10.10.4:6": "10.10.100.2",
 }
 
 
@@ -134,11 +151,22 @@ def plot(events, events_times, new_advertisers, withdrawn_advertisers):
 
 
 def compute_convergence(event_times):
-    tmp = []
-    for times in event_times:
-        tmp.append((times[-1] - times[0]).total_seconds())
-    print("Convergence Mean: {}".format(statistics.mean(tmp)))
-    print("Convergence Stdev: {}".format(statistics.stdev(tmp)))
+    lengths = numpy.fromiter(map(len, event_times), numpy.int64,
+                             len(event_times))
+    times = to_datetime64(numpy.concatenate(event_times))
+    # Last and first timestamp of every non-empty event
+    last = numpy.cumsum(lengths)[lengths > 0] - 1
+    first = last - lengths[lengths > 0] + 1
+    durations = (times[last] - times[first]) / numpy.timedelta64(1, "s")
+    print("Convergence Mean: {}".format(durations.mean()))
+    print("Convergence Stdev: {}".format(
+        durations.std(ddof=1) if len(durations) > 1 else float("nan")))
+
+
+def to_datetime64(timestamps):
+    """timestamps, datetimes or ISO 8601 strings, as a datetime64[ns] array,
+    strings are all parsed in one go."""
+    return numpy.asarray(timestamps, dtype="datetime64[ns]")
 
 
 def set_es_parameters():
@@ -151,55 +179,171 @@ def set_es_parameters():
         es_index = file.readline().replace("\n", "")
 
 
-def launch_request(query):
-    header = {
-        "Content-Type": "application/json"
-    }
-    response = requests.get(
-        "http://{}:{}/{}/_search/?size=10000".format(es_host, es_port, target), data=json.dumps(query), headers=header)
-    return response.json()
-
-
-def retrieve_mac_info(mac):
-    query = {
-        "query": {
-            "term": {
-                "bgp_message.update.mac_address.keyword": {
-                    "value": mac
-                }
+def es_url(path):
+    return "http://{}:{}/{}".format(es_host, es_port, path)
+
+
+def launch_request(query, source=None):
+    """Yield every hit of query in timestamp_received order, a page at a time
+    through a point in time and search_after. source lists the _source
+    fields returned, all of them when None."""
+    response = session.post(es_url("{}/_pit?keep_alive={}".format(
+        target, keep_alive)))
+    response.raise_for_status()
+    pit = response.json()["id"]
+    body = dict(query, size=page_size, track_total_hits=False, sort=[
+        {"timestamp_received": "asc"}, {"_shard_doc": "asc"}])
+    if source is not None:
+        body["_source"] = source
+    try:
+        while True:
+            body["pit"] = {"id": pit, "keep_alive": keep_alive}
+            response = session.post(es_url("_search"), json=body)
+            response.raise_for_status()
+            result = response.json()
+            pit = result.get("pit_id", pit)
+            hits = result["hits"]["hits"]
+            yield from hits
+            if len(hits) < page_size:
+                break
+            body["search_after"] = hits[-1]["sort"]
+    finally:
+        session.delete(es_url("_pit"), json={"id": pit})
+
+
+def launch_aggregation(query, sources, aggregations=None, nested=None,
+                       size=None):
+    """Yield the buckets of a composite aggregation on sources over the hits
+    of query, a page of size buckets (page_size by default) at a time. Only
+    the buckets are shipped, the counting and grouping happens in
+    Elasticsearch. With nested, the path of nested documents, the buckets
+    are of those (the routes of the UPDATEs)."""
+    composite = {"size": size or page_size, "sources": sources}
+    if aggregations is not None:
+        buckets = {"composite": composite, "aggregations": aggregations}
+    else:
+        buckets = {"composite": composite}
+    if nested is not None:
+        buckets = {"nested": {"path": nested},
+                   "aggregations": {"buckets": buckets}}
+    body = dict(query, size=0, track_total_hits=False,
+                aggregations={"buckets": buckets})
+    while True:
+        response = session.post(es_url("{}/_search".format(target)),
+                                json=body)
+        response.raise_for_status()
+        result = response.json()["aggregations"]["buckets"]
+        if nested is not None:
+            result = result["buckets"]
+        yield from result["buckets"]
+        if not result["buckets"] or "after_key" not in result:
+            break
+        composite["after"] = result["after_key"]
+
+
+def time_span(query):
+    """Seconds between the first and the last hit of query."""
+    body = dict(query, size=0, track_total_hits=False, aggregations={
+        "span": {"stats": {"field": "timestamp_received"}}})
+    response = session.post(es_url("{}/_search".format(target)), json=body)
+    response.raise_for_status()
+    span = response.json()["aggregations"]["span"]
+    if not span["count"]:
+        return 0
+    return (span["max"] - span["min"]) / 1000
+
+
+interval_units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def interval_seconds(interval):
+    """Length of a fixed_interval such as 30s or 1m."""
+    number = interval.rstrip("smhd")
+    return float(number) * interval_units[interval[len(number):]]
+
+
+def bucket_time(key):
+    """The date_histogram bucket key, epoch milliseconds, as a datetime."""
+    return datetime.datetime.fromtimestamp(
+        key / 1000, datetime.timezone.utc).replace(tzinfo=None)
+
+
+updates_query = {
+    "query": {
+        "term": {
+            "bgp_message.message_type": {
+                "value": "UPDATE"
             }
         }
     }
-    return launch_request(query)
+}
 
 
-def retrieve_updates():
-    query = {
-        "query": {
-            "term": {
-                "bgp_message.message_type.keyword": {
-                    "value": "UPDATE"
+def fetch_updates(since=None, source=None):
+    """The UPDATEs from since, in epoch milliseconds, on."""
+    query = updates_query
+    if since is not None:
+        query = {
+            "query": {
+                "bool": {
+                    "filter": [
+                        updates_query["query"],
+                        {"range": {"timestamp_received": {
+                            "gte": since, "format": "epoch_millis"}}}
+                    ]
                 }
             }
         }
-    }
-    return launch_request(query)
-
-
-def retrieve_opens():
+    return launch_request(query, source)
+
+
+def load_updates():
+    """The cache of the target's UPDATEs, brought up to date first."""
+    cache = update_cache.UpdateCache(os.path.join(
+        cache_directory, "{}_{}_{}".format(es_host, es_port, target)))
+    added = cache.refresh(lambda since: fetch_updates(
+        since, update_cache.source), rebuild_cache)
+    print("{} routes cached, {} new".format(len(cache), added))
+    return cache
+
+
+def cached_documents(cache):
+    """The cached routes grouped back into hits of their UPDATE, in the
+    shape retrieve_updates() yields."""
+    starts = numpy.flatnonzero(numpy.diff(cache.document, prepend=-1))
+    ends = numpy.append(starts[1:], len(cache))
+    times = numpy.datetime_as_string(
+        cache.timestamp.astype("datetime64[ns]"), unit="us")
+    types = numpy.where(cache.reachable, "New Route", "Withdrawn")
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield {"_source": {
+            "timestamp_received": str(times[start]),
+            "bgp_message": {"update": [{
+                "type": str(types[row]),
+                "route_distinguisher": str(cache.rd[row]),
+                "mac_address": str(cache.mac[row]),
+            } for row in range(start, end)]}
+        }}
+
+
+def retrieve_updates(source=None):
+    return launch_request(updates_query, source)
+
+
+def retrieve_opens(source=None):
     query = {
         "query": {
             "term": {
-                "bgp_message.message_type.keyword": {
+                "bgp_message.message_type": {
                     "value": "OPEN"
                 }
             }
         }
     }
-    return launch_request(query)
+    return launch_request(query, source)
 
 
-def retrieve_ceases():
+def retrieve_ceases(source=None):
     query = {
         "query": {
             "term": {
@@ -209,42 +353,37 @@ def retrieve_ceases():
             }
         }
     }
-    return launch_request(query)
+    return launch_request(query, source)
+
 
+def intervals(adv_timestamps):
+    """Seconds between consecutive timestamps."""
+    return numpy.diff(to_datetime64(adv_timestamps)).astype(
+        numpy.int64) / 1e9
 
-def find_mean_timedelta(adv_timestamps, adv):
-    mean_delta = 0
-    count = 0
-    intervals = []
-    for x in range(len(adv_timestamps) - 1):
-        intervals.append((adv_timestamps[x+1] -
-                          adv_timestamps[x]).total_seconds())
-        # print(intervals[-1])
-        count += 1
-    mean_delta = statistics.mean(intervals)
-    stdev_delta = statistics.stdev(intervals)
-    return mean_delta, stdev_delta
+
+def interval_stats(deltas):
+    if len(deltas) < 2:
+        return float("nan"), float("nan")
+    return deltas.mean(), deltas.std(ddof=1)
 
 
 def find_events(adv, adv_timestamps):
-    events = []
-    events_times = []
-    delimiters = []
-    bgn = 0
-    mean_delta, stdev_delta = find_mean_timedelta(adv_timestamps, adv)
-    print((mean_delta) * (len(adv) / (stdev_delta)))
-    for x in range(len(adv_timestamps) - 1):
-        if (adv_timestamps[x+1] - adv_timestamps[x]).total_seconds() > (mean_delta) * (tolerance * len(adv) / (stdev_delta)):
-            delimiters.append(x)
-    for x in delimiters:
-        events.append(adv[bgn:x+1])
-        events_times.append(adv_timestamps[bgn:x+1])
-        bgn = x + 1
-    events.append(adv[bgn:])
-    events_times.append(adv_timestamps[bgn:])
-    if not events:
-        events = adv
-        events_times = adv_timestamps
+    """Split adv, and its timestamps, where the gap to the next update is
+    far above the mean interval. The timestamps of every event come back as
+    a datetime64[ns] array."""
+    times = to_datetime64(adv_timestamps)
+    deltas = intervals(times)
+    mean_delta, stdev_delta = interval_stats(deltas)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        threshold = mean_delta * (tolerance * len(adv) / stdev_delta)
+        print(mean_delta * (len(adv) / stdev_delta))
+        # An event starts after every gap above the threshold
+        starts = numpy.flatnonzero(deltas > threshold) + 1
+    bounds = [0] + starts.tolist() + [len(adv)]
+    events = [adv[begin:end] for begin, end in zip(bounds, bounds[1:])]
+    events_times = [times[begin:end]
+                    for begin, end in zip(bounds, bounds[1:])]
     return events, events_times
 
 
@@ -260,40 +399,27 @@ def get_advertisers(events, new_advertisers, withdrawn_advertisers):
 
 
 def analyze_mac(mac):
-    mac_info = retrieve_mac_info(mac)["hits"]["hits"]
-    tmp = []
+    cache = load_updates()
+    rows = numpy.flatnonzero(cache.mac == mac)
+    rows = rows[numpy.argsort(cache.timestamp[rows], kind="stable")]
+    adv = []
     new_advertisers = []
     withdrawn_advertisers = []
-    mac_info = sorted(mac_info, key=lambda d: dateutil.parser.isoparse(
-        d["_source"]["timestamp_received"]).timestamp())
-    for entry in mac_info:
-        bmp = entry["_source"]
-        adv_type = None
-        for up in bmp["bgp_message"]["update"]:
-            try:
-                if up["type"] == "New Route":
-                    try:
-                        adv_type = nlri_possibilities[0]
-                        new_advertisers.append(
-                            rd_to_anycast[up["route_distinguisher"]])
-                        withdrawn_advertisers.append(None)
-                    except KeyError:
-                        pass
-                elif up["type"] == "Withdrawn":
-                    try:
-                        adv_type = nlri_possibilities[1]
-                        withdrawn_advertisers.append(
-                            rd_to_anycast[up["route_distinguisher"]])
-                        new_advertisers.append(None)
-                    except KeyError:
-                        pass
-                tmp.append((adv_type, dateutil.parser.isoparse(
-                    bmp["timestamp_received"])))
-            except KeyError:
-                print("This isn't an update: ",
-                      bmp["bgp_message"]["message_type"])
-    adv = [x for x, _ in tmp]
-    adv_timestamps = [x for _, x in tmp]
+    for row in rows:
+        rd = str(cache.rd[row])
+        try:
+            if cache.reachable[row]:
+                adv_type = nlri_possibilities[0]
+                new_advertisers.append(rd_to_anycast[rd])
+                withdrawn_advertisers.append(None)
+            else:
+                adv_type = nlri_possibilities[1]
+                withdrawn_advertisers.append(rd_to_anycast[rd])
+                new_advertisers.append(None)
+        except KeyError:
+            pass
+        adv.append(adv_type)
+    adv_timestamps = cache.times(rows)
     events, events_times = find_events(adv, adv_timestamps)
     new_advertisers, withdrawn_advertisers = get_advertisers(
         events, new_advertisers, withdrawn_advertisers)
@@ -301,29 +427,49 @@ def analyze_mac(mac):
     compute_convergence(events_times)
 
 
-def find_all_macs(data):
-    macs = []
-    lis = [x["_source"]["bgp_message"]["update"] for x in data]
-    for x in lis:
-        for y in x:
-            try:
-                macs.append(y["mac_address"])
-            except KeyError:
-                pass
-    macs = set(macs)
-    return macs
+def index_macs(data):
+    """MAC -> the updates carrying it, in the order of data, in one pass over
+    every NLRI. Each update keeps only the routes of that MAC."""
+    index = {}
+    for x in data:
+        source = x["_source"]
+        routes = source["bgp_message"]["update"]
+        by_mac = {}
+        for route in routes:
+            mac = route.get("mac_address")
+            if mac:
+                by_mac.setdefault(mac, []).append(route)
+        for mac, mac_routes in by_mac.items():
+            if len(mac_routes) == len(routes):
+                index.setdefault(mac, []).append(x)
+            else:
+                index.setdefault(mac, []).append({"_source": {
+                    "timestamp_received": source["timestamp_received"],
+                    "bgp_message": {"update": mac_routes}}})
+    return index
+
+
+def set_tolerance(value):
+    global tolerance
+    tolerance = value
+
 
+def mac_events(updates):
+    events, _ = find_events(updates, to_datetime64(
+        [x["_source"]["timestamp_received"] for x in updates]))
+    return events
 
-def find_macs_events(data):
-    macs = find_all_macs(data)
-    ret = {}
-    for mac in macs:
-        events = [x for x in data if x["_source"]
-                  ["bgp_message"]["update"][0]["mac_address"] == mac]
-        events, _ = find_events(events, [dateutil.parser.isoparse(
-            x["_source"]["timestamp_received"]) for x in events])
-        ret[mac] = events
-    return ret
+
+def find_macs_events(data, workers=1):
+    """MAC -> its updates split into events. With workers > 1 the MACs are
+    split between that many processes."""
+    index = index_macs(data)
+    if workers <= 1:
+        return {mac: mac_events(updates) for mac, updates in index.items()}
+    with multiprocessing.Pool(workers, set_tolerance, (tolerance,)) as pool:
+        events = pool.map(mac_events, index.values(),
+                          chunksize=max(1, len(index) // (workers * 4)))
+    return dict(zip(index, events))
 
 
 def find_rds(data):
@@ -373,10 +519,8 @@ def plot_graph(mac, tree, labels_list):
 
 
 def detect_flapping():
-    updates = retrieve_updates()["hits"]["hits"]
-    updates = sorted(updates, key=lambda d: dateutil.parser.isoparse(
-        d["_source"]["timestamp_received"]).timestamp())
-    mac_events = find_macs_events(updates)
+    updates = list(cached_documents(load_updates()))
+    mac_events = find_macs_events(updates, workers)
     for mac in mac_events.keys():
         labels = []
         tree = EventTree()
@@ -418,7 +562,8 @@ def detect_flapping():
 
 def sessions():
     events = dict()
-    for event_open in retrieve_opens()['hits']['hits']:
+    for event_open in retrieve_opens(['timestamp_received',
+                                      'bgp_message.open']):
         if not (event_open['_source']['bgp_message']['open']['peer_one']['bgp_identifier'].startswith('10.10.') and
                 event_open['_source']['bgp_message']['open']['peer_two']['bgp_identifier'].startswith('10.10.')):
             continue
@@ -428,7 +573,8 @@ def sessions():
         event = (dateutil.parser.isoparse(
             event_open['_source']['timestamp_received']), 'UP')
         events[label] = [event] + events[label] if label in events else [event]
-    for event_cease in retrieve_ceases()['hits']['hits']:
+    for event_cease in retrieve_ceases([
+            'timestamp_received', 'bmp_header.per_peer_header.bgp_id']):
         label = event_cease['_source']['bmp_header']['per_peer_header']['bgp_id']
         if not label.startswith('10.10.'):
             continue
@@ -473,7 +619,9 @@ def session_id(peer_one, peer_two='*'):
 
 def prefixes():
     events = dict()
-    for event in retrieve_updates()['hits']['hits']:
+    for event in retrieve_updates(['timestamp_received',
+                                   'bgp_message.update',
+                                   'bgp_message.as_path']):
         for update in event['_source']['bgp_message']['update']:
             if update['evpn_route_type'] != 'IP Prefix Route':
                 continue
@@ -524,34 +672,139 @@ def plot_mac_mobility(mac_mm_counters, timestamps):
     plt.show()
 
 
-def analyse_mac_mobility():
-    updates = retrieve_updates()["hits"]["hits"]
-    updates = sorted(updates, key=lambda d: dateutil.parser.isoparse(
-        d["_source"]["timestamp_received"]).timestamp())
-    mac_events = find_all_macs(updates)
-    mac_mm_counters = {x: [] for x, _ in zip(mac_events, mac_events)}
-    timestamps = []
-    for u in updates:
-        update = u["_source"]["bgp_message"]
-        try:
-            mac = update["update"][0]["mac_address"]
-            for ec in update["extended_communities"]:
-                if ec["type"] == "EVPN" and ec["subtype"] == "MAC Mobility":
-                    mac_mm_counters[mac].append(ec["4_bytes_value"])
-                    break
-        except:
-            pass
-        timestamps.append(dateutil.parser.isoparse(
-            u["_source"]["timestamp_received"]))
-        for k in mac_mm_counters.keys():
-            if mac_mm_counters[k]:
-                while len(mac_mm_counters[k]) < len(timestamps):
-                    mac_mm_counters[k].append(mac_mm_counters[k][-1])
+def analyse_mac_mobility(interval="1m"):
+    # Every MAC of a page brings its own histogram, as many MACs are asked
+    # for as fit in max_buckets when each is updated in every interval
+    intervals = int(time_span(updates_query) // interval_seconds(interval)) + 1
+    size = min(page_size, max(1, max_buckets // (2 * intervals)))
+    if 2 * intervals > max_buckets:
+        print("{} intervals of {} may go over search.max_buckets, use a "
+              "longer interval if the search fails".format(intervals,
+                                                           interval))
+    # Highest MAC Mobility sequence number of every MAC per interval, the
+    # time and communities are back on the UPDATE of the route
+    buckets = launch_aggregation(updates_query, [
+        {"mac": {"terms": {"field": "bgp_message.update.mac_address"}}}], {
+        "updates": {
+            "reverse_nested": {},
+            "aggregations": {
+                "time": {
+                    "date_histogram": {"field": "timestamp_received",
+                                       "fixed_interval": interval,
+                                       "min_doc_count": 1},
+                    "aggregations": {
+                        "communities": {
+                            "nested": {
+                                "path": "bgp_message.extended_communities"},
+                            "aggregations": {
+                                "mac_mobility": {
+                                    "filter": {"term": {
+                                        "bgp_message.extended_communities"
+                                        ".subtype": "MAC Mobility"}},
+                                    "aggregations": {
+                                        "sequence": {"max": {
+                                            "field": "bgp_message."
+                                            "extended_communities."
+                                            "4_bytes_value"
+                                        }}
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }, "bgp_message.update", size)
+    sequences = {}
+    for bucket in buckets:
+        for interval_bucket in bucket["updates"]["time"]["buckets"]:
+            sequence = interval_bucket["communities"]["mac_mobility"][
+                "sequence"]["value"]
+            if sequence is not None:
+                sequences.setdefault(bucket["key"]["mac"], {})[
+                    interval_bucket["key"]] = sequence
+    keys = sorted({key for values in sequences.values() for key in values})
+    timestamps = [bucket_time(key) for key in keys]
+    mac_mm_counters = {}
+    for mac, values in sequences.items():
+        # Carried forward over the intervals without an update
+        counters = mac_mm_counters[mac] = []
+        last = float("nan")
+        for key in keys:
+            last = values.get(key, last)
+            counters.append(last)
     plot_mac_mobility(mac_mm_counters, timestamps)
 
 
+def mac_update_counts(top=50):
+    # Routes carrying the MAC, an UPDATE may carry it more than once
+    counts = [(bucket["key"]["mac"], bucket["doc_count"])
+              for bucket in launch_aggregation(updates_query, [
+                  {"mac": {"terms": {
+                      "field": "bgp_message.update.mac_address"}}}],
+                  nested="bgp_message.update")]
+    counts.sort(key=lambda item: item[1], reverse=True)
+    print("{} MACs".format(len(counts)))
+    for mac, count in counts[:top]:
+        print("{}  {}".format(mac, count))
+
+
+def update_volume(interval="1s"):
+    # NLRIs per interval, the interval is of the UPDATE and the type of
+    # each of its routes
+    volume = {"New Route": {}, "Withdrawn": {}}
+    for bucket in launch_aggregation(updates_query, [
+            {"time": {"date_histogram": {"field": "timestamp_received",
+                                         "fixed_interval": interval}}}], {
+            "routes": {
+                "nested": {"path": "bgp_message.update"},
+                "aggregations": {
+                    "type": {"terms": {"field": "bgp_message.update.type"}}
+                }
+            }}):
+        for type_bucket in bucket["routes"]["type"]["buckets"]:
+            volume.setdefault(type_bucket["key"], {})[
+                bucket["key"]["time"]] = type_bucket["doc_count"]
+    for label, color in zip(volume, ["b", "r"]):
+        keys = sorted(volume[label])
+        plt.plot([bucket_time(key) for key in keys],
+                 [volume[label][key] for key in keys], color=color,
+                 label=label)
+    plt.legend(loc='best')
+    plt.xlabel('Time')
+    plt.ylabel('Updates per {}'.format(interval))
+    plt.gcf().autofmt_xdate()
+    plt.show()
+
+
+def rd_counts():
+    counts = {}
+    # NLRIs of every RD and type
+    for bucket in launch_aggregation(updates_query, [
+            {"rd": {"terms": {
+                "field": "bgp_message.update.route_distinguisher"}}},
+            {"type": {"terms": {"field": "bgp_message.update.type"}}}],
+            nested="bgp_message.update"):
+        counts.setdefault(bucket["key"]["rd"], {})[
+            bucket["key"]["type"]] = bucket["doc_count"]
+    print("{:<24} {:<16} {:>10} {:>10}".format(
+        "RD", "anycast", "New Route", "Withdrawn"))
+    for rd in sorted(counts):
+        print("{:<24} {:<16} {:>10} {:>10}".format(
+            rd, rd_to_anycast.get(rd, "-"), counts[rd].get("New Route", 0),
+            counts[rd].get("Withdrawn", 0)))
+
+
 if __name__ == "__main__":
     set_es_parameters()
+    if "--rebuild-cache" in sys.argv:
+        sys.argv.remove("--rebuild-cache")
+        rebuild_cache = True
+    if "--workers" in sys.argv:
+        position = sys.argv.index("--workers")
+        workers = int(sys.argv[position + 1])
+        del sys.argv[position:position + 2]
     option = sys.argv[1]
     target = sys.argv[-1]
     if option == "--mac-analysis":
@@ -569,4 +822,16 @@ if __name__ == "__main__":
     elif option == "--prefixes":
         prefixes()
     elif option == "--mac-mobility":
-        analyse_mac_mobility()
+        if len(sys.argv) > 3:
+            analyse_mac_mobility(sys.argv[2])
+        else:
+            analyse_mac_mobility()
+    elif option == "--mac-counts":
+        mac_update_counts()
+    elif option == "--update-volume":
+        if len(sys.argv) > 3:
+            update_volume(sys.argv[2])
+        else:
+            update_volume()
+    elif option == "--rds":
+        rd_counts()
@@ -0,0 +1,190 @@
+"""Offline replay of captured BMP streams.
+
+The capture is memory-mapped and split into chunks ending on message
+boundaries, found from the BMP length fields alone. Chunks are parsed and
+encoded in a process pool and their documents written in capture order, to
+an NDJSON file, to Elasticsearch or nowhere (to measure the parse speed):
+
+    python replay.py capture.bin --output documents.ndjson
+    python replay.py capture.bin --es-url http://localhost:9200 --index lab
+
+A capture keeps no time of arrival, timestamp_received is the per-peer
+header timestamp the router put on each message.
+"""
+import argparse
+import collections
+import datetime
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+import es_index
+import es_sink
+import evpn_parser
+import message_filter
+import serialization
+
+capture = None
+
+
+def chunk_boundaries(blob, chunk_size):
+    """Return the (start, end) chunks of about chunk_size bytes covering
+    every complete message of blob, and the number of messages."""
+    chunks = []
+    start = pos = 0
+    messages = 0
+    header = evpn_parser.bmp_common_header
+    size = len(blob)
+    while size - pos >= header.size:
+        version, length, _ = header.unpack_from(blob, pos)
+        if version != 3 or length < header.size:
+            raise evpn_parser.FramingError(pos)
+        if pos + length > size:
+            break
+        pos += length
+        messages += 1
+        if pos - start >= chunk_size:
+            chunks.append((start, pos))
+            start = pos
+    if pos > start:
+        chunks.append((start, pos))
+    if pos < size:
+        print("Ignoring {} bytes of a truncated message at the end".format(
+            size - pos), file=sys.stderr)
+    return chunks, messages
+
+
+def open_capture(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def init_worker(path):
+    global capture
+    capture = open_capture(path)
+
+
+def parse_chunk(chunk, selection=None):
+    """Parse one chunk of the capture, returns its encoded documents."""
+    documents = []
+    start, end = chunk
+    view = memoryview(capture)[start:end]
+    # Messages without a router timestamp take the one before them
+    last = None
+
+    def emit(message):
+        nonlocal last
+        header = message.per_peer_header
+        if header is not None:
+            timestamp = datetime.datetime.fromisoformat(header.timestamp_real)
+            # Zero when the router does not fill it in
+            if timestamp.year > 1970:
+                last = timestamp
+        if last is not None:
+            message.timestamp_received = last
+        documents.append(serialization.encode_message(message))
+
+    try:
+        evpn_parser.run(view, emit, selection)
+    finally:
+        view.release()
+    return documents
+
+
+class FileSink:
+
+    def __init__(self, path):
+        self.file = sys.stdout.buffer if path == "-" else open(path, "wb")
+
+    def submit(self, document):
+        self.file.write(document + b"\n")
+
+    def close(self):
+        self.file.flush()
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+class NullSink:
+
+    def submit(self, document):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay(path, sink, workers=None, chunk_size=8 * 1024 * 1024,
+           selection=None):
+    """Parse the capture at path in worker processes and submit its encoded
+    documents to sink in capture order. Returns the number of messages and
+    documents."""
+    blob = open_capture(path)
+    try:
+        chunks, messages = chunk_boundaries(blob, chunk_size)
+    finally:
+        blob.close()
+    workers = workers or os.cpu_count()
+    documents = 0
+    with multiprocessing.Pool(workers, init_worker, (path,)) as pool:
+        # A bounded window of chunks in flight, results are taken in order
+        pending = collections.deque(
+            pool.apply_async(parse_chunk, (chunk, selection))
+            for chunk in chunks[:2 * workers])
+        queued = len(pending)
+        while pending:
+            batch = pending.popleft().get()
+            if queued < len(chunks):
+                pending.append(pool.apply_async(
+                    parse_chunk, (chunks[queued], selection)))
+                queued += 1
+            for document in batch:
+                sink.submit(document)
+            documents += len(batch)
+    return messages, documents
+
+
+def add_sink_arguments(parser):
+    parser.add_argument("--output", help="write NDJSON documents to this "
+                        "file, - for stdout")
+    parser.add_argument("--es-url", help="index the documents in this "
+                        "Elasticsearch")
+    parser.add_argument("--index", default="replay",
+                        help="alias written to, see es_index")
+
+
+def make_sink(args):
+    """The sink chosen by the add_sink_arguments() options, NullSink when
+    none is."""
+    if args.output and args.es_url:
+        raise SystemExit("--output and --es-url cannot be combined")
+    if args.output:
+        return FileSink(args.output)
+    if args.es_url:
+        es_index.setup(args.es_url, args.index)
+        return es_sink.BulkSink(args.es_url, args.index)
+    return NullSink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a BMP capture")
+    parser.add_argument("capture")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=8 * 1024 * 1024,
+                        help="bytes of capture parsed per task")
+    add_sink_arguments(parser)
+    message_filter.add_arguments(parser)
+    args = parser.parse_args()
+    sink = make_sink(args)
+    began = time.perf_counter()
+    try:
+        messages, documents = replay(args.capture, sink, args.workers,
+                                     args.chunk_size,
+                                     message_filter.from_arguments(args))
+    finally:
+        sink.close()
+    elapsed = time.perf_counter() - began
+    print("{} messages, {} documents in {:.1f}s, {:.0f} msg/s, {:.1f} MB/s".format(
+        messages, documents, elapsed, messages / elapsed,
+        os.path.getsize(args.capture) / elapsed / 1e6), file=sys.stderr)
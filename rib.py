@@ -0,0 +1,252 @@
+"""Live EVPN Adj-RIB-In of every monitored peer.
+
+Route Monitoring UPDATEs are applied as they are parsed: MP_REACH NLRIs
+insert or replace a route, MP_UNREACH NLRIs remove it, a Peer Up or Peer
+Down flushes the peer. A Termination or the close of a BMP session flushes
+every peer learned over it. Routes are indexed by MAC, IP, RD, ESI and prefix, so
+questions such as where a MAC currently is are answered from memory:
+
+    rib.mac_location("00:11:22:33:44:55")
+    rib.routes_for_rd("10.10.10.1:6")
+
+The same queries are served as JSON under /rib/ on the metrics port.
+"""
+import sys
+import threading
+import evpn_parser
+
+index_names = ("mac", "ip", "rd", "esi", "prefix")
+
+
+class RibRoute:
+    __slots__ = ("peer", "route", "next_hop", "extended_communities",
+                 "timestamp_real")
+
+    def __init__(self, peer, route, next_hop, extended_communities,
+                 timestamp_real):
+        self.peer = peer
+        self.route = route
+        self.next_hop = next_hop
+        self.extended_communities = extended_communities
+        self.timestamp_real = timestamp_real
+
+    def to_dict(self):
+        document = self.route.to_dict()
+        del document["type"]
+        document["peer_distinguisher"], document["peer_address"] = self.peer
+        document["next_hop"] = self.next_hop
+        document["timestamp_real"] = self.timestamp_real
+        if self.extended_communities is not None:
+            document["extended_communities"] = [
+                ec.to_dict() for ec in self.extended_communities]
+        return document
+
+
+def route_key(route):
+    """What identifies a route within one peer's Adj-RIB-In, withdrawals
+    carry the same fields as the advertisement they remove."""
+    if route.evpn_route_type == "MAC Advertisement":
+        return (route.evpn_route_type, route.route_distinguisher,
+                route.ethernet_tag_id, route.mac_address, route.ip_address)
+    return (route.evpn_route_type, route.route_distinguisher,
+            route.ethernet_tag_id, route.ip_address, route.ip_prefix_length)
+
+
+def index_keys(route):
+    keys = [("rd", str(route.route_distinguisher))]
+    if route.ip_address is not None:
+        keys.append(("ip", route.ip_address))
+    if route.esi:
+        # ESI 0 is every single-homed route, not worth an index entry
+        keys.append(("esi", route.esi))
+    if route.evpn_route_type == "MAC Advertisement":
+        keys.append(("mac", route.mac_address))
+    else:
+        keys.append(("prefix", "{}/{}".format(route.ip_address,
+                                              route.ip_prefix_length)))
+    return keys
+
+
+def deep_size(root):
+    """Bytes used by root and everything it references, each object counted
+    once."""
+    seen = set()
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (bool, type)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif hasattr(obj, "__slots__"):
+            pending.extend(getattr(obj, name) for name in obj.__slots__
+                           if hasattr(obj, name))
+    return size
+
+
+class Rib:
+    """Adj-RIB-In per peer, a peer being its (peer distinguisher, address).
+
+    Updated from the parse path and queried from the HTTP thread, so both
+    sides take the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.peers = {}
+        # BMP session -> the peers learned over it
+        self.connections = {}
+        self.indexes = {name: {} for name in index_names}
+        self.inserts = 0
+        self.removes = 0
+        self.bytes_per_route = None
+
+    def apply(self, message, connection=None):
+        """Apply a parsed message. connection identifies the BMP session it
+        came over, for the Termination or close_connection() of that session
+        to flush its peers, messages without one are only flushed by peer."""
+        message_type = evpn_parser.bmp_message_types[message.bmp_message_type]
+        header = message.per_peer_header
+        if header is None:
+            if message_type == "Termination Message" and \
+                    connection is not None:
+                self.close_connection(connection)
+            return
+        peer = (str(header.peer_distinguisher), header.address)
+        with self.lock:
+            if connection is not None:
+                self.connections.setdefault(connection, set()).add(peer)
+            if message_type in ("Peer Down Notification",
+                                "Peer Up Notification"):
+                # A peer coming up again starts from an empty Adj-RIB-In
+                self._flush_peer(peer)
+            elif message_type == "Route Monitoring" and message.update:
+                routes = self.peers.setdefault(peer, {})
+                for route in message.update:
+                    if route.reachable:
+                        self._insert(peer, routes, route, message,
+                                     header.timestamp_real)
+                    else:
+                        self._remove(routes, route_key(route))
+
+    def _insert(self, peer, routes, route, message, timestamp_real):
+        key = route_key(route)
+        if key in routes:
+            self._remove(routes, key)
+        entry = routes[key] = RibRoute(peer, route, message.next_hop,
+                                       message.extended_communities,
+                                       timestamp_real)
+        for name, value in index_keys(route):
+            self.indexes[name].setdefault(value, set()).add(entry)
+        self.inserts += 1
+
+    def _remove(self, routes, key):
+        entry = routes.pop(key, None)
+        if entry is None:
+            return
+        for name, value in index_keys(entry.route):
+            index = self.indexes[name]
+            members = index[value]
+            members.discard(entry)
+            if not members:
+                del index[value]
+        self.removes += 1
+
+    def _flush_peer(self, peer):
+        routes = self.peers.get(peer)
+        if routes is None:
+            return
+        for key in list(routes):
+            self._remove(routes, key)
+        del self.peers[peer]
+
+    def close_connection(self, connection):
+        """Flush the peers learned over a BMP session that ended."""
+        with self.lock:
+            for peer in self.connections.pop(connection, ()):
+                self._flush_peer(peer)
+
+    def query(self, index, value):
+        """Routes whose index field equals value, across all peers."""
+        with self.lock:
+            return list(self.indexes[index].get(value, ()))
+
+    def mac_location(self, mac):
+        """Where a MAC currently is: the peers advertising it, with next hop,
+        RD, ESI and the extended communities (MAC Mobility sequence)."""
+        return self.query("mac", mac.lower().replace("-", ":"))
+
+    def routes_for_ip(self, ip):
+        return self.query("ip", ip)
+
+    def routes_for_rd(self, rd):
+        return self.query("rd", rd)
+
+    def routes_for_esi(self, esi):
+        """esi as in the documents, colon separated hex, or a number."""
+        if ":" in esi:
+            esi = esi.replace(":", "")
+            return self.query("esi", int(esi, 16))
+        return self.query("esi", int(esi))
+
+    def routes_for_prefix(self, prefix):
+        return self.query("prefix", prefix)
+
+    def peer_routes(self, address):
+        with self.lock:
+            return [entry for peer, routes in self.peers.items()
+                    if peer[1] == address for entry in routes.values()]
+
+    def route_count(self):
+        return sum(len(routes) for routes in self.peers.values())
+
+    def stats(self):
+        """Counts and memory use. Measuring walks every object of the RIB
+        with the lock held, so it is only done on request."""
+        with self.lock:
+            routes = self.route_count()
+            memory = deep_size((self.peers, self.indexes))
+        if routes:
+            self.bytes_per_route = memory // routes
+        return {
+            "peers": len(self.peers),
+            "routes": routes,
+            "inserts": self.inserts,
+            "removes": self.removes,
+            "memory_bytes": memory,
+            "bytes_per_route": self.bytes_per_route,
+        }
+
+    def report(self):
+        with self.lock:
+            line = "rib {} peers, {} routes".format(len(self.peers),
+                                                    self.route_count())
+        if self.bytes_per_route is not None:
+            line += ", {} bytes/route when last measured".format(
+                self.bytes_per_route)
+        return line
+
+    def http_query(self, path):
+        """Answer /rib/<index>/<value> and /rib/stats, None if unknown."""
+        parts = path.split("/", 1)
+        if parts[0] == "stats":
+            return self.stats()
+        if len(parts) != 2:
+            return None
+        queries = {
+            "mac": self.mac_location,
+            "ip": self.routes_for_ip,
+            "rd": self.routes_for_rd,
+            "esi": self.routes_for_esi,
+            "prefix": self.routes_for_prefix,
+            "peer": self.peer_routes,
+        }
+        if parts[0] not in queries:
+            return None
+        return [entry.to_dict() for entry in queries[parts[0]](parts[1])]
@@ -0,0 +1,148 @@
+"""Compact JSON encoding of parsed BMP messages.
+
+Every message is encoded once, to the bytes that go into bulk requests or
+files. orjson is used when it is installed. Without it, documents are built
+from pre-encoded constant fragments (route types, document skeleton), since
+every value the parser produces is a number, null or a string that needs no
+escaping.
+"""
+import functools
+import json
+import bmp_records
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+encoder_name = "orjson" if orjson is not None else "json"
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def _string(value):
+    if value is None:
+        return "null"
+    return '"' + value + '"'
+
+
+@functools.lru_cache(maxsize=4096)
+def _generic(value):
+    # Table lookups can yield either names or raw codes, fall back to json
+    return json.dumps(value)
+
+
+route_prefixes = {
+    ("MAC Advertisement", True): '{"evpn_route_type":"MAC Advertisement","type":"New Route",',
+    ("MAC Advertisement", False): '{"evpn_route_type":"MAC Advertisement","type":"Withdrawn",',
+    ("IP Prefix Route", True): '{"evpn_route_type":"IP Prefix Route","type":"New Route",',
+    ("IP Prefix Route", False): '{"evpn_route_type":"IP Prefix Route","type":"Withdrawn",',
+}
+
+
+def _mac_route(route):
+    return (route_prefixes[route.evpn_route_type, route.reachable] +
+            '"route_distinguisher":"%s","esi":"%s","ethernet_tag_id":%d,'
+            '"mac_address":%s,"ip_address":%s,"mpls_label":"%s"}' % (
+                route.route_distinguisher, bmp_records.format_esi(route.esi), route.ethernet_tag_id,
+                _string(route.mac_address), _string(route.ip_address),
+                route.mpls_label))
+
+
+def _ip_prefix_route(route):
+    return (route_prefixes[route.evpn_route_type, route.reachable] +
+            '"route_distinguisher":"%s","esi":"%s","ethernet_tag_id":%d,'
+            '"ip_prefix_length":%d,"ip_address":%s,"ip_gateway":%s,'
+            '"mpls_label":"%s"}' % (
+                route.route_distinguisher, bmp_records.format_esi(route.esi), route.ethernet_tag_id,
+                route.ip_prefix_length, _string(route.ip_address),
+                _string(route.ip_gateway), route.mpls_label))
+
+
+route_encoders = {
+    "MAC Advertisement": _mac_route,
+    "IP Prefix Route": _ip_prefix_route,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def _extended_community_head(ec_type, ec_subtype):
+    return '{"type":%s,"subtype":%s,' % (_generic(ec_type), _generic(ec_subtype))
+
+
+def _extended_community(ec):
+    return (_extended_community_head(ec.ec_type, ec.ec_subtype) +
+            '"2_bytes_value":%d,"4_bytes_value":%d}' % (
+                ec.global_adm, ec.local_adm))
+
+
+def _per_peer_header(header):
+    return ('{"peer_type":%d,"flags":%d,"peer_distinguisher":"%s",'
+            '"address":%s,"as_number":%d,"bgp_id":%s}' % (
+                header.peer_type, header.flags, header.peer_distinguisher,
+                _string(header.address), header.as_number,
+                _string(header.bgp_id)))
+
+
+def _bgp_message(message):
+    parts = ['"message_type":"%s","length":%d' % (
+        message.bgp_message_type, message.bgp_length)]
+    if message.notification is not None:
+        parts.append('"notification":{"error_code":%d,"error_subcode":%d}' %
+                     message.notification)
+    if message.opens is not None:
+        parts.append('"open":{%s}' % ",".join(
+            '"%s":{"bgp_version":%d,"my_as":%d,"bgp_identifier":%s}' % (
+                peer, open_message.bgp_version, open_message.my_as,
+                _string(open_message.bgp_identifier))
+            for peer, open_message in zip(("peer_one", "peer_two"),
+                                          message.opens)))
+    if message.update is not None:
+        parts.append('"update":[%s]' % ",".join(
+            route_encoders[route.evpn_route_type](route)
+            for route in message.update))
+    if message.extended_communities is not None:
+        parts.append('"extended_communities":[%s]' % ",".join(
+            _extended_community(ec) for ec in message.extended_communities))
+    if message.as_path is not None:
+        parts.append('"as_path":[%s]' % ",".join(
+            str(asn) for asn in message.as_path))
+    return '"bgp_message":{' + ",".join(parts) + '}'
+
+
+def _encode_fragments(message):
+    parts = ['{"timestamp_received":"%s","bmp_header":{"bmp_version":%d,'
+             '"message_length":%d,"message_type":%d' % (
+                 message.timestamp_received.isoformat(), message.bmp_version,
+                 message.message_length, message.bmp_message_type)]
+    if message.per_peer_header is not None:
+        parts.append(',"per_peer_header":' +
+                     _per_peer_header(message.per_peer_header))
+    if message.local_address is not None:
+        parts.append(',"local_address":%s,"local_port":%d,"remote_port":%d' % (
+            _string(message.local_address), message.local_port,
+            message.remote_port))
+    if message.peer_down_reason is not None:
+        parts.append(',"peer_down_reason":%d' % message.peer_down_reason)
+    parts.append('}')
+    if message.per_peer_header is not None:
+        parts.append(',"timestamp_real":"%s"' %
+                     message.per_peer_header.timestamp_real)
+    if message.bgp_message_type is not None:
+        parts.append(',' + _bgp_message(message))
+    if message.coalesced is not None:
+        parts.append(',"coalesced":' + dumps(
+            message.coalesced.to_dict()).decode())
+    parts.append('}')
+    return "".join(parts).encode()
+
+
+def encode_message(message):
+    """Return the compact JSON document of a parsed message, as bytes."""
+    if orjson is not None:
+        return orjson.dumps(message.to_dict())
+    return _encode_fragments(message)
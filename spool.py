@@ -0,0 +1,230 @@
+"""Durable on-disk spool of raw framed BMP messages.
+
+The listener appends every framed message to the spool and never waits on
+Elasticsearch. A consumer thread reads the spool back, parses and hands the
+messages to the sink, and once the sink confirms they are indexed the read
+position is checkpointed. Messages are kept across Elasticsearch outages and
+restarts: after one, the consumer reads the backlog sequentially at full
+bulk speed. Delivery is at-least-once, messages read after the last
+checkpoint are indexed again after a restart.
+
+The spool is a directory of numbered segment files, written with large
+buffered appends and deleted once fully checkpointed. Every frame is
+recorded behind its length and arrival time, the timestamp_received of its
+document however late it is read back.
+"""
+import datetime
+import functools
+import logging
+import os
+import struct
+import threading
+import evpn_parser
+
+log = logging.getLogger("spool")
+
+checkpoint_name = "checkpoint"
+segment_suffix = ".bmp"
+# Frame length and arrival time, epoch seconds
+record_header = struct.Struct("!Id")
+
+
+class Spool:
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 buffer_size=1024 * 1024, read_size=4 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.read_size = read_size
+        os.makedirs(directory, exist_ok=True)
+        # Guards the writer position, the reader waits on it for new data
+        self.condition = threading.Condition()
+        segments = self.segments()
+        self.committed = self._load_checkpoint(segments)
+        # Never append after what a crash may have left half written
+        self.write_segment = segments[-1] + 1 if segments else 0
+        self.file = open(self._path(self.write_segment), "ab",
+                         buffering=buffer_size)
+        self.written = 0
+        self.flushed = 0
+        self.read_segment, self.read_offset = self.committed
+        self.reader = None
+
+    def _path(self, segment):
+        return os.path.join(self.directory,
+                            "{:012d}{}".format(segment, segment_suffix))
+
+    def segments(self):
+        return sorted(int(name[:-len(segment_suffix)])
+                      for name in os.listdir(self.directory)
+                      if name.endswith(segment_suffix))
+
+    def _load_checkpoint(self, segments):
+        try:
+            with open(os.path.join(self.directory, checkpoint_name)) as f:
+                segment, offset = (int(field) for field in f.read().split())
+        except FileNotFoundError:
+            return (segments[0] if segments else 0), 0
+        if segments and segment < segments[0]:
+            return segments[0], 0
+        return segment, offset
+
+    # Writer side, called from the event loop
+
+    def append(self, frame, arrived):
+        self.file.write(record_header.pack(len(frame), arrived))
+        self.file.write(frame)
+        self.written += record_header.size + len(frame)
+        if self.written >= self.segment_size:
+            self._roll()
+
+    def flush(self):
+        """Make what was appended visible to the reader."""
+        self.file.flush()
+        with self.condition:
+            self.flushed = self.written
+            self.condition.notify_all()
+
+    def _roll(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        with self.condition:
+            self.write_segment += 1
+            self.written = self.flushed = 0
+            self.file = open(self._path(self.write_segment), "ab",
+                             buffering=self.buffer_size)
+            self.condition.notify_all()
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if self.reader is not None:
+            self.reader.close()
+
+    # Reader side, called from the consumer thread
+
+    def read(self):
+        """Return the complete records, (arrival time, frame) pairs,
+        available past the read position, and the position after them, ([],
+        position) when caught up."""
+        while True:
+            with self.condition:
+                current = self.read_segment == self.write_segment
+                limit = self.flushed if current else None
+            if self.reader is None:
+                self.reader = open(self._path(self.read_segment), "rb")
+            self.reader.seek(self.read_offset)
+            amount = self.read_size
+            if limit is not None:
+                amount = min(amount, limit - self.read_offset)
+            blob = self.reader.read(amount) if amount > 0 else b""
+            view = memoryview(blob)
+            frames = []
+            pos = 0
+            while pos + record_header.size <= len(blob):
+                length, arrived = record_header.unpack_from(blob, pos)
+                end = pos + record_header.size + length
+                if end > len(blob):
+                    break
+                frames.append((arrived, view[pos + record_header.size:end]))
+                pos = end
+            if len(blob) == self.read_size and not frames:
+                # A frame larger than a read, take it whole
+                self.read_size *= 2
+                continue
+            self.read_offset += pos
+            if frames or current:
+                return frames, (self.read_segment, self.read_offset)
+            if len(blob) > pos:
+                log.warning("Skipping %d bytes of a truncated message at the "
+                            "end of segment %d", len(blob) - pos,
+                            self.read_segment)
+            self.reader.close()
+            self.reader = None
+            self.read_segment += 1
+            self.read_offset = 0
+
+    def wait(self, timeout):
+        with self.condition:
+            if self.read_segment == self.write_segment and \
+                    self.read_offset >= self.flushed:
+                self.condition.wait(timeout)
+
+    def commit(self, position):
+        """Checkpoint position once everything before it is indexed, and
+        delete the segments it leaves behind."""
+        path = os.path.join(self.directory, checkpoint_name)
+        with open(path + ".tmp", "w") as f:
+            f.write("{} {}\n".format(*position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        for segment in range(self.committed[0], position[0]):
+            try:
+                os.remove(self._path(segment))
+            except FileNotFoundError:
+                pass
+        self.committed = position
+
+    def pending(self):
+        """Bytes written but not checkpointed yet."""
+        with self.condition:
+            write_segment = self.write_segment
+            written = self.written
+        segment, offset = self.committed
+        if segment == write_segment:
+            return written - offset
+        total = written - offset
+        for earlier in range(segment, write_segment):
+            try:
+                total += os.path.getsize(self._path(earlier))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def report(self):
+        return "spool {} bytes pending, segment {}".format(
+            self.pending(), self.write_segment)
+
+
+class SpoolConsumer:
+    """Thread parsing the spool into emit, checkpointing through the sink.
+
+    After each read the position is handed to sink.checkpoint(), which
+    commits it once every document submitted before is indexed.
+    """
+
+    def __init__(self, spool, sink, emit=None):
+        self.spool = spool
+        self.sink = sink
+        self.emit = emit or sink.submit
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            frames, position = self.spool.read()
+            if not frames:
+                self.spool.wait(0.5)
+                continue
+            for arrived, frame in frames:
+                if self.stopping.is_set():
+                    # The rest of the read is not checkpointed, so not lost
+                    return
+                message = evpn_parser.parse_message(frame)
+                if message is not None:
+                    message.timestamp_received = \
+                        datetime.datetime.fromtimestamp(arrived)
+                    self.emit(message)
+            self.sink.checkpoint(functools.partial(self.spool.commit, position))
+
+    def close(self):
+        """Stop after the current read. Whatever the sink cannot send right
+        away is left to be read again after a restart."""
+        self.stopping.set()
+        self.sink.stop_retrying()
+        self.thread.join()
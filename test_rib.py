@@ -0,0 +1,87 @@
+import json
+import unittest
+import bmp_synth
+import evpn_parser
+import rib
+import serialization
+
+
+class PeerDownTest(unittest.TestCase):
+
+    def setUp(self):
+        self.peer = bmp_synth.make_peers(1)[0]
+        rd = bmp_synth.route_distinguisher(self.peer["address"], 1)
+        self.announce = bmp_synth.bmp_message(0, bmp_synth.per_peer_header(
+            self.peer, 0) + bmp_synth.update(self.peer, bmp_synth.mac_route(
+                rd, bytes.fromhex("001122334455"), "10.1.0.1", 257), False, 1))
+
+    def parse(self, blob):
+        messages = []
+        evpn_parser.run(blob, messages.append)
+        return messages
+
+    def test_peer_down_without_notification_flushes_peer(self):
+        adj_rib = rib.Rib()
+        for message in self.parse(bmp_synth.peer_up(self.peer, 0) +
+                                  self.announce):
+            adj_rib.apply(message)
+        self.assertEqual(adj_rib.route_count(), 1)
+        messages = self.parse(bmp_synth.peer_down(self.peer, 1, reason=2))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].peer_down_reason, 2)
+        adj_rib.apply(messages[0])
+        self.assertEqual(adj_rib.route_count(), 0)
+        self.assertEqual(adj_rib.mac_location("00:11:22:33:44:55"), [])
+
+    def test_peer_down_with_any_notification_flushes_peer(self):
+        for error_code in (4, 42):
+            adj_rib = rib.Rib()
+            for message in self.parse(self.announce):
+                adj_rib.apply(message)
+            message, = self.parse(bmp_synth.peer_down(
+                self.peer, 1, reason=1, error_code=error_code))
+            self.assertEqual(message.notification, (error_code, 2))
+            adj_rib.apply(message)
+            self.assertEqual(adj_rib.route_count(), 0)
+
+    def test_peer_up_resets_peer(self):
+        adj_rib = rib.Rib()
+        for message in self.parse(self.announce):
+            adj_rib.apply(message)
+        message, = self.parse(bmp_synth.peer_up(self.peer, 1))
+        adj_rib.apply(message)
+        self.assertEqual(adj_rib.route_count(), 0)
+
+    def test_session_end_flushes_its_peers(self):
+        other = bmp_synth.make_peers(2)[1]
+        rd = bmp_synth.route_distinguisher(other["address"], 1)
+        other_announce = bmp_synth.bmp_message(0, bmp_synth.per_peer_header(
+            other, 0) + bmp_synth.update(other, bmp_synth.mac_route(
+                rd, bytes.fromhex("00112233aabb"), "10.1.0.2", 257), False, 1))
+        adj_rib = rib.Rib()
+        for message in self.parse(self.announce):
+            adj_rib.apply(message, ("192.0.2.1", 40000))
+        for message in self.parse(other_announce):
+            adj_rib.apply(message, ("192.0.2.2", 40000))
+        message, = self.parse(bmp_synth.termination())
+        adj_rib.apply(message, ("192.0.2.1", 40000))
+        self.assertEqual(adj_rib.mac_location("00:11:22:33:44:55"), [])
+        self.assertEqual(adj_rib.route_count(), 1)
+        adj_rib.close_connection(("192.0.2.2", 40000))
+        self.assertEqual(adj_rib.route_count(), 0)
+
+    def test_peer_down_documents(self):
+        for reason in (1, 2, 4, 5):
+            message, = self.parse(bmp_synth.peer_down(self.peer, 1, reason))
+            document = json.loads(serialization.encode_message(message))
+            self.assertEqual(document, json.loads(
+                serialization._encode_fragments(message)))
+            header = document["bmp_header"]
+            self.assertEqual(header["peer_down_reason"], reason)
+            self.assertEqual(header["per_peer_header"]["address"],
+                             self.peer["address"])
+            self.assertEqual("bgp_message" in document, reason == 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
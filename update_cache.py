@@ -0,0 +1,172 @@
+"""Local columnar cache of the UPDATEs of an index, for plots.py.
+
+Every route of every UPDATE is one row, flattened to the fields the
+analyses use:
+
+    timestamp    timestamp_received, int64 nanoseconds
+    document     number of the UPDATE the route came in, to group routes
+    peer         per-peer header address
+    mac          MAC address, empty for IP Prefix routes
+    rd           route distinguisher
+    route_type   EVPN route type
+    reachable    True for an advertisement, False for a withdrawal
+    mm_sequence  MAC Mobility sequence number of the UPDATE, -1 when absent
+
+The cache is kept on disk, one file per index, as Parquet when pyarrow is
+installed and as a NumPy .npz otherwise. A refresh only fetches the
+documents from the cached high-water mark on, so repeated analyses read
+nothing but the new documents. Documents indexed late, with a timestamp
+older than the high-water mark (replayed from a spool after an outage), are
+only picked up by a rebuild.
+"""
+import os
+import numpy
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+columns = ("timestamp", "document", "peer", "mac", "rd", "route_type",
+           "reachable", "mm_sequence")
+
+# The _source fields flatten() reads
+source = ["timestamp_received", "bmp_header.per_peer_header.address",
+          "bgp_message.update.mac_address",
+          "bgp_message.update.route_distinguisher",
+          "bgp_message.update.evpn_route_type", "bgp_message.update.type",
+          "bgp_message.extended_communities"]
+
+
+def empty():
+    return {
+        "timestamp": numpy.empty(0, numpy.int64),
+        "document": numpy.empty(0, numpy.int64),
+        "peer": numpy.empty(0, str),
+        "mac": numpy.empty(0, str),
+        "rd": numpy.empty(0, str),
+        "route_type": numpy.empty(0, str),
+        "reachable": numpy.empty(0, bool),
+        "mm_sequence": numpy.empty(0, numpy.int64),
+    }
+
+
+def flatten(hits, first_document=0):
+    """Columns of the routes of hits, documents numbered from
+    first_document."""
+    rows = {name: [] for name in columns}
+    document = first_document
+    for hit in hits:
+        document_source = hit["_source"]
+        bgp_message = document_source.get("bgp_message", {})
+        routes = bgp_message.get("update")
+        if not routes:
+            continue
+        try:
+            peer = document_source["bmp_header"]["per_peer_header"]["address"]
+        except KeyError:
+            peer = ""
+        sequence = -1
+        for ec in bgp_message.get("extended_communities", ()):
+            if ec["subtype"] == "MAC Mobility":
+                sequence = ec["4_bytes_value"]
+                break
+        for route in routes:
+            rows["timestamp"].append(document_source["timestamp_received"])
+            rows["document"].append(document)
+            rows["peer"].append(peer)
+            rows["mac"].append(route.get("mac_address") or "")
+            rows["rd"].append(route["route_distinguisher"])
+            rows["route_type"].append(route["evpn_route_type"])
+            rows["reachable"].append(route["type"] == "New Route")
+            rows["mm_sequence"].append(sequence)
+        document += 1
+    if not rows["timestamp"]:
+        return empty()
+    flat = {name: numpy.array(values) for name, values in rows.items()}
+    # ISO 8601 strings are parsed in one go
+    flat["timestamp"] = flat["timestamp"].astype(
+        "datetime64[ns]").astype(numpy.int64)
+    flat["document"] = flat["document"].astype(numpy.int64)
+    flat["mm_sequence"] = flat["mm_sequence"].astype(numpy.int64)
+    return flat
+
+
+def concatenate(first, second):
+    return {name: numpy.concatenate((first[name], second[name]))
+            for name in columns}
+
+
+class UpdateCache:
+    """The cached columns of one index, attributes named after columns."""
+
+    def __init__(self, path):
+        self.path = path + (".parquet" if pyarrow is not None else ".npz")
+        self.columns = self._load()
+
+    def __getattr__(self, name):
+        if name in columns:
+            return self.columns[name]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.columns["timestamp"])
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return empty()
+        if pyarrow is not None:
+            table = pyarrow.parquet.read_table(self.path)
+            return {name: table.column(name).to_numpy() for name in columns}
+        with numpy.load(self.path) as data:
+            return {name: data[name] for name in columns}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary = self.path + ".tmp"
+        if pyarrow is not None:
+            pyarrow.parquet.write_table(pyarrow.table(self.columns),
+                                        temporary)
+        else:
+            with open(temporary, "wb") as f:
+                numpy.savez(f, **self.columns)
+        os.replace(temporary, self.path)
+
+    def high_water_mark(self):
+        """Start of the millisecond of the newest cached document, in
+        nanoseconds, None when empty."""
+        if not len(self):
+            return None
+        # Elasticsearch compares dates in milliseconds
+        return int(self.columns["timestamp"].max()) // 1000000 * 1000000
+
+    def refresh(self, fetch, rebuild=False):
+        """Add the documents fetch(since) yields, since being the epoch
+        milliseconds to fetch from, None for everything. Returns the number
+        of routes added."""
+        if rebuild:
+            self.columns = empty()
+        since = self.high_water_mark()
+        kept = self.columns
+        if since is not None:
+            # Refetched, later documents of that millisecond may be new
+            keep = kept["timestamp"] < since
+            kept = {name: values[keep] for name, values in kept.items()}
+            since //= 1000000
+        first_document = int(kept["document"].max()) + 1 \
+            if len(kept["document"]) else 0
+        added = flatten(fetch(since), first_document)
+        before = len(self)
+        self.columns = concatenate(kept, added)
+        # The refetched millisecond alone changes nothing
+        if rebuild or len(self) != before:
+            self.save()
+        return len(self) - before
+
+    def times(self, rows=None):
+        """The timestamps of rows as a datetime64[ns] array."""
+        timestamps = self.columns["timestamp"]
+        if rows is not None:
+            timestamps = timestamps[rows]
+        return timestamps.astype("datetime64[ns]")